@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import subprocess
+from contextlib import closing
+from hashlib import sha1
+from time import time
+
+
+# Put a file in place without copying its data when the file system allows it
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        subprocess.check_call(["cp", "--reflink=auto", source, target])
+
+
+# A directory of files keyed by name and checksum, trimmed to a size limit by evicting the least recently used
+class FileCache():
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_path(self, name, checksum):
+        digest = sha1(str(checksum).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}-{name}")
+
+    def fetch(self, name, checksum, target):
+        path = self.get_path(name, checksum)
+        if not os.path.exists(path):
+            return False
+        # The modification time records when an entry was last used
+        os.utime(path)
+        if os.path.exists(target):
+            os.unlink(target)
+        link_file(path, target)
+        return True
+
+    def store(self, source, name, checksum):
+        path = self.get_path(name, checksum)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        link_file(source, temp_path)
+        os.utime(temp_path)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except FileNotFoundError:
+                continue
+
+        total_size = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            total_size += size
+            if total_size > self.max_size:
+                print(f"Evicting {path} from cache")
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+# DEM tiles and the mosaics built from them. Mosaics are named after the bounding box they were built for,
+# so a granule whose bounding box lies inside an earlier one can reuse that mosaic as it is
+class DemCache(FileCache):
+
+    def fetch_tile(self, dem_type, tile, target):
+        return self.fetch(f"{dem_type}_{tile}.tif", dem_type, target)
+
+    def store_tile(self, source, dem_type, tile):
+        self.store(source, f"{dem_type}_{tile}.tif", dem_type)
+
+    def fetch_mosaic(self, bounding_box, target_dir="."):
+        mosaics = []
+        for entry in os.scandir(self.cache_dir):
+            name = entry.name.split("-", 1)[-1]
+            if not name.startswith("mosaic_") or not name.endswith(".tif"):
+                continue
+            dem_type, lat_min, lon_min, lat_max, lon_max = name[len("mosaic_"):-len(".tif")].rsplit("_", 4)
+            lat_min, lon_min, lat_max, lon_max = float(lat_min), float(lon_min), float(lat_max), float(lon_max)
+            if lat_min <= bounding_box["lat_min"] and lon_min <= bounding_box["lon_min"] and lat_max >= bounding_box["lat_max"] and lon_max >= bounding_box["lon_max"]:
+                mosaics.append(((lat_max - lat_min) * (lon_max - lon_min), dem_type, name))
+
+        # The smallest mosaic that covers the bounding box is the cheapest one to hand to SNAP
+        for area, dem_type, name in sorted(mosaics):
+            if self.fetch(name, dem_type, os.path.join(target_dir, f"{dem_type}.tif")):
+                return dem_type
+        return None
+
+    def store_mosaic(self, dem_file, dem_type, bounding_box):
+        corners = [bounding_box["lat_min"], bounding_box["lon_min"], bounding_box["lat_max"], bounding_box["lon_max"]]
+        name = "_".join(["mosaic", dem_type] + [str(corner) for corner in corners]) + ".tif"
+        self.store(dem_file, name, dem_type)
+
+
+# Granule information looked up from CMR, kept for a limited time in a SQLite database
+class MetadataStore():
+
+    def __init__(self, database, ttl):
+        self.database = database
+        self.ttl = ttl
+        with closing(self._connect()) as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS granules (granule TEXT PRIMARY KEY, download_url TEXT, polygon TEXT, size INTEGER, updated REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=60)
+
+    def get_many(self, granules):
+        records = {}
+        with closing(self._connect()) as connection:
+            for granule in granules:
+                row = connection.execute("SELECT download_url, polygon, size FROM granules WHERE granule = ? AND updated > ?", (granule, time() - self.ttl)).fetchone()
+                if row:
+                    records[granule] = {"download_url": row[0], "polygon": row[1], "size": row[2]}
+        return records
+
+    def put_many(self, records):
+        now = time()
+        rows = [(granule, record["download_url"], record["polygon"], record["size"], now) for granule, record in records.items()]
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?)", rows)
@@ -0,0 +1,421 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+from shutil import copytree, rmtree
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from lxml import etree
+
+ENVI_DATA_TYPES = {1: "u1", 2: "i2", 3: "i4", 4: "f4", 5: "f8", 12: "u2", 13: "u4"}
+ENVI_HEADER = """ENVI
+description = {{{description}}}
+samples = {samples}
+lines = {lines}
+bands = 1
+header offset = 0
+file type = ENVI Standard
+data type = 4
+interleave = bsq
+byte order = 1
+band names = {{ {band} }}
+"""
+UTC_FORMAT = "%d-%b-%Y %H:%M:%S.%f"
+
+# Lee Sigma constants SNAP uses for single look intensity with a sigma of 0.9: the range around the prior
+# estimate that pixels are selected from, and the speckle standard deviation within that range
+LEE_SIGMA_I1 = 0.084
+LEE_SIGMA_I2 = 3.941
+LEE_SIGMA_VP = 0.8191
+LEE_SIGMA_WINDOW = 7
+LEE_SIGMA_TARGET_WINDOW = 3
+LEE_SIGMA_CHUNK_ROWS = 4
+POINT_TARGET_PERCENTILE = 98
+POINT_TARGET_COUNT = 5
+POINT_TARGET_SAMPLING = 4
+
+
+# ENVI rasters of BEAM-DIMAP products, which SNAP writes big endian
+def read_envi_header(hdr_file):
+    header = {}
+    with open(hdr_file, "r") as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                header[key.strip()] = value.strip()
+    return header
+
+
+def open_band(img_file, mode="r"):
+    header = read_envi_header(img_file.replace(".img", ".hdr"))
+    byte_order = ">" if header.get("byte order", "1") == "1" else "<"
+    dtype = np.dtype(byte_order + ENVI_DATA_TYPES[int(header["data type"])])
+    return np.memmap(img_file, dtype=dtype, mode=mode, shape=(int(header["lines"]), int(header["samples"])))
+
+
+def create_band(img_file, band, lines, samples):
+    with open(img_file.replace(".img", ".hdr"), "w") as f:
+        f.write(ENVI_HEADER.format(description=band, samples=samples, lines=lines, band=band))
+    with open(img_file, "wb") as f:
+        f.truncate(lines * samples * 4)
+
+
+# Tiles are strips of whole rows of the target band. Each worker opens the bands itself and reads the rows it
+# needs, halo included, so memory use is set by the tile size rather than the scene size
+def process_tile(kernel, source_files, target_file, start, end, parameters):
+    sources = [open_band(source_file) for source_file in source_files]
+    target = open_band(target_file, "r+")
+    kernel(sources, target, start, end, **parameters)
+    target.flush()
+
+
+def run_tiled(kernel, source_files, target_file, tile_rows, jobs, **parameters):
+    lines = open_band(target_file).shape[0]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_tile, kernel, source_files, target_file, start, min(start + tile_rows, lines), parameters) for start in range(0, lines, tile_rows)]
+        for future in futures:
+            future.result()
+
+
+# BEAM-DIMAP products
+def find_element(parent, *names):
+    for name in names:
+        if parent is None:
+            return None
+        parent = parent.find(f"MDElem[@name='{name}']")
+    return parent
+
+
+def get_attribute(element, name):
+    return element.findtext(f"MDATTR[@name='{name}']")
+
+
+def set_attribute(element, name, value):
+    attribute = element.find(f"MDATTR[@name='{name}']") if element is not None else None
+    if attribute is not None:
+        attribute.text = str(value)
+
+
+class Product():
+
+    def __init__(self, dim_file, tree=None):
+        self.dim_file = dim_file
+        self.data_dir = dim_file.replace(".dim", ".data")
+        self.tree = tree if tree is not None else etree.parse(dim_file)
+        self.root = self.tree.getroot()
+
+    @property
+    def width(self):
+        return int(self.root.findtext("Raster_Dimensions/NCOLS"))
+
+    @property
+    def height(self):
+        return int(self.root.findtext("Raster_Dimensions/NROWS"))
+
+    @property
+    def metadata(self):
+        return find_element(self.root.find("Dataset_Sources"), "metadata", "Abstracted_Metadata")
+
+    def get_original_metadata(self, *names):
+        return find_element(self.root.find("Dataset_Sources"), "metadata", "Original_Product_Metadata", *names)
+
+    # Bands stored in files, by name, leaving out virtual bands
+    def get_bands(self):
+        files = {}
+        for data_file in self.root.iterfind("Data_Access/Data_File"):
+            href = data_file.find("DATA_FILE_PATH").get("href")
+            files[data_file.findtext("BAND_INDEX")] = os.path.join(self.data_dir, os.path.basename(href).replace(".hdr", ".img"))
+        bands = {}
+        for band_info in self.root.iterfind("Image_Interpretation/Spectral_Band_Info"):
+            index = band_info.findtext("BAND_INDEX")
+            if index in files:
+                bands[band_info.findtext("BAND_NAME")] = files[index]
+        return bands
+
+    # A product with the same metadata and tie point grids holding new float32 bands of the given size
+    def derive(self, target_dim, bands, width, height):
+        target = Product(target_dim, deepcopy(self.tree))
+        root = target.root
+        root.find("Raster_Dimensions/NCOLS").text = str(width)
+        root.find("Raster_Dimensions/NROWS").text = str(height)
+        root.find("Raster_Dimensions/NBANDS").text = str(len(bands))
+        set_attribute(target.metadata, "num_samples_per_line", width)
+        set_attribute(target.metadata, "num_output_lines", height)
+
+        template = root.find("Image_Interpretation/Spectral_Band_Info")
+        for parent, tag in [("Image_Interpretation", "Spectral_Band_Info"), ("Data_Access", "Data_File"), ("Image_Display", "Band_Statistics")]:
+            for element in root.iterfind(f"{parent}/{tag}"):
+                element.getparent().remove(element)
+
+        data_access = root.find("Data_Access")
+        first_grid_file = data_access.find("Tie_Point_Grid_File")
+        for index, (name, unit) in enumerate(bands):
+            data_file = etree.Element("Data_File")
+            etree.SubElement(data_file, "DATA_FILE_PATH", href=f"{os.path.basename(target.data_dir)}/{name}.hdr")
+            etree.SubElement(data_file, "BAND_INDEX").text = str(index)
+            if first_grid_file is not None:
+                first_grid_file.addprevious(data_file)
+            else:
+                data_access.append(data_file)
+
+            band_info = deepcopy(template)
+            for tag in ["VIRTUAL_BAND", "EXPRESSION", "VALID_MASK_TERM"]:
+                for element in band_info.findall(tag):
+                    band_info.remove(element)
+            values = {
+                "BAND_INDEX": index, "BAND_NAME": name, "BAND_RASTER_WIDTH": width, "BAND_RASTER_HEIGHT": height,
+                "DATA_TYPE": "float32", "PHYSICAL_UNIT": unit, "NO_DATA_VALUE_USED": "true", "NO_DATA_VALUE": 0.0,
+                "SCALING_FACTOR": 1.0, "SCALING_OFFSET": 0.0, "LOG10_SCALED": "false",
+            }
+            for tag, value in values.items():
+                element = band_info.find(tag)
+                if element is None:
+                    element = etree.SubElement(band_info, tag)
+                element.text = str(value)
+            root.find("Image_Interpretation").append(band_info)
+
+        # Left behind by a run that failed part way
+        if os.path.isdir(target.data_dir):
+            rmtree(target.data_dir)
+        os.makedirs(target.data_dir)
+        for directory in ["tie_point_grids", "vector_data"]:
+            if os.path.isdir(os.path.join(self.data_dir, directory)):
+                copytree(os.path.join(self.data_dir, directory), os.path.join(target.data_dir, directory))
+        return target
+
+    def get_band_file(self, name):
+        return os.path.join(self.data_dir, f"{name}.img")
+
+    def write(self):
+        for data_file in self.root.iterfind("Data_Access/Data_File"):
+            href = data_file.find("DATA_FILE_PATH")
+            href.set("href", f"{os.path.basename(self.data_dir)}/{os.path.basename(href.get('href'))}")
+        for grid_file in self.root.iterfind("Data_Access/Tie_Point_Grid_File"):
+            href = grid_file.find("TIE_POINT_GRID_FILE_PATH")
+            href.set("href", f"{os.path.basename(self.data_dir)}/tie_point_grids/{os.path.basename(href.get('href'))}")
+        self.tree.write(self.dim_file, xml_declaration=True, encoding="ISO-8859-1", pretty_print=True)
+
+
+# Calibration to beta0 from the calibration vectors of the annotation, as SNAP does for Sentinel-1 GRD
+def get_calibration_vectors(product):
+    vectors = {}
+    for calibration_file in product.get_original_metadata("calibration").iterfind("MDElem"):
+        calibration = find_element(calibration_file, "calibration")
+        polarization = get_attribute(find_element(calibration, "adsHeader"), "polarisation")
+        lines, pixels, values = [], [], []
+        for vector in calibration.iterfind("MDElem[@name='calibrationVectorList']/MDElem[@name='calibrationVector']"):
+            lines.append(int(get_attribute(vector, "line")))
+            pixels.append(np.array(get_attribute(find_element(vector, "pixel"), "pixel").split(), dtype=np.float64))
+            values.append(np.array(get_attribute(find_element(vector, "betaNought"), "betaNought").split(), dtype=np.float64))
+        vectors[polarization] = (np.array(lines), pixels, values)
+    return vectors
+
+
+# Calibration values of a block of rows, interpolated linearly along each vector and then between vectors
+def interpolate_calibration(vectors, start, end, samples):
+    lines, pixels, values = vectors
+    columns = np.arange(samples)
+    along_vectors = np.array([np.interp(columns, vector_pixels, vector_values) for vector_pixels, vector_values in zip(pixels, values)])
+    rows = np.arange(start, end)
+    index = np.clip(np.searchsorted(lines, rows, side="right") - 1, 0, len(lines) - 2)
+    weight = np.clip((rows - lines[index]) / (lines[index + 1] - lines[index]), 0, 1)[:, None]
+    return along_vectors[index] * (1 - weight) + along_vectors[index + 1] * weight
+
+
+def calibration_kernel(sources, target, start, end, vectors):
+    amplitude = sources[0][start:end].astype(np.float64)
+    calibration = interpolate_calibration(vectors, start, end, amplitude.shape[1])
+    target[start:end] = amplitude ** 2 / calibration ** 2
+
+
+def calibrate(source_dim, target_dim, parameters, jobs, tile_rows):
+    if parameters.get("outputBetaBand") != "true" or parameters.get("outputSigmaBand", "true") != "false":
+        raise ValueError("The NumPy engine only calibrates to beta0")
+    source = Product(source_dim)
+    vectors = get_calibration_vectors(source)
+    amplitudes = {name[len("Amplitude_"):]: img_file for name, img_file in source.get_bands().items() if name.startswith("Amplitude_")}
+
+    target = source.derive(target_dim, [(f"Beta0_{polarization}", "intensity") for polarization in amplitudes], source.width, source.height)
+    for polarization, img_file in amplitudes.items():
+        target_file = target.get_band_file(f"Beta0_{polarization}")
+        create_band(target_file, f"Beta0_{polarization}", source.height, source.width)
+        run_tiled(calibration_kernel, [img_file], target_file, tile_rows, jobs, vectors=vectors[polarization])
+    set_attribute(target.metadata, "abs_calibration_flag", 1)
+    target.write()
+
+
+# Lee Sigma speckle filter
+# The part of a padded block a halo of the given width surrounds
+def crop(padded, halo):
+    return padded[halo:padded.shape[0] - halo, halo:padded.shape[1] - halo]
+
+
+# A window around each pixel of a padded block, as a read only view of shape (rows, columns, window, window)
+def get_windows(padded, half, window):
+    base = padded[half - window // 2:, half - window // 2:]
+    height, width = crop(padded, half).shape
+    return as_strided(base, shape=(height, width, window, window), strides=base.strides * 2, writeable=False)
+
+
+# Number of set pixels in the window around each pixel, from the integral image of the mask. Counts are
+# integers, so the cumulative sums are exact however large the block
+def count_windows(mask, window):
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = mask.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+    return integral[window:, window:] - integral[:-window, window:] - integral[window:, :-window] + integral[:-window, :-window]
+
+
+# Minimum mean square error estimate for multiplicative noise of the given standard deviation
+def mmse(values, mean, variance, noise):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        signal_variance = (variance - mean ** 2 * noise ** 2) / (1 + noise ** 2)
+        weight = np.nan_to_num(np.clip(signal_variance / variance, 0, 1))
+    return mean + weight * (values - mean)
+
+
+# The 98th percentile of the band, from a regular sample of its pixels so that it is the same for every tile
+def get_point_target_threshold(img_file):
+    sample = np.array(open_band(img_file)[::POINT_TARGET_SAMPLING, ::POINT_TARGET_SAMPLING])
+    sample = sample[sample != 0]
+    return float(np.percentile(sample, POINT_TARGET_PERCENTILE)) if sample.size else np.inf
+
+
+# Pixels at or above the threshold with enough such neighbours in the target window are point targets, kept
+# unfiltered along with the bright pixels around them. They are found over the halo as well, since those
+# next to the block spread into it
+def get_point_targets(padded, half, threshold):
+    with np.errstate(invalid="ignore"):
+        bright = padded >= threshold
+    point = np.zeros(padded.shape, dtype=bool)
+    crop(point, 1)[...] = crop(bright, 1) & (count_windows(bright, LEE_SIGMA_TARGET_WINDOW) >= POINT_TARGET_COUNT)
+    near_point = crop(count_windows(point, LEE_SIGMA_TARGET_WINDOW), half - 1) > 0
+    return near_point & crop(bright, half)
+
+
+# Rows of the filtered block, from their target windows, used for the prior estimate, and their full windows.
+# The windows are copied out of the padded block so that the reductions over them run on contiguous memory
+def filter_rows(center, target_windows, target_counts, windows):
+    target_windows = np.ascontiguousarray(target_windows).reshape(center.shape + (-1,))
+    windows = np.ascontiguousarray(windows).reshape(center.shape + (-1,))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = target_windows.sum(axis=2) / target_counts
+        prior = mmse(center, mean, np.einsum("ijk,ijk->ij", target_windows, target_windows) / target_counts - mean ** 2, 1.0)
+
+        # Statistics of the pixels in the window that fall within the sigma range of the prior estimate. No
+        # data is zero in the windows, below any range
+        selected = (windows >= (prior * LEE_SIGMA_I1)[:, :, None]) & (windows <= (prior * LEE_SIGMA_I2)[:, :, None])
+        values = windows * selected
+        count = selected.sum(axis=2)
+        selected_mean = values.sum(axis=2) / count
+        filtered = mmse(center, selected_mean, np.einsum("ijk,ijk->ij", values, windows) / count - selected_mean ** 2, LEE_SIGMA_VP)
+    return np.where(count > 0, filtered, prior)
+
+
+# Filters a NaN padded block a few rows at a time, which bounds the memory the window statistics take. The
+# statistics are summed in float32 like the band itself, which keeps the output within a relative 1e-5 of the
+# same filter computed in float64
+def lee_sigma(padded, half, threshold):
+    valid = ~np.isnan(padded)
+    filled = np.where(valid, padded, 0)
+    center = crop(padded, half)
+    target_windows = get_windows(filled, half, LEE_SIGMA_TARGET_WINDOW)
+    target_counts = crop(count_windows(valid, LEE_SIGMA_TARGET_WINDOW), half - 1)
+    windows = get_windows(filled, half, LEE_SIGMA_WINDOW)
+
+    filtered = np.empty(center.shape)
+    for start in range(0, center.shape[0], LEE_SIGMA_CHUNK_ROWS):
+        rows = slice(start, start + LEE_SIGMA_CHUNK_ROWS)
+        filtered[rows] = filter_rows(center[rows], target_windows[rows], target_counts[rows], windows[rows])
+
+    point = get_point_targets(padded, half, threshold)
+    filtered[point] = center[point]
+    return np.nan_to_num(np.where(crop(valid, half), filtered, 0))
+
+
+# Zero is no data, so it becomes NaN and drops out of the window statistics
+def read_padded(source, start, end, half):
+    lines, samples = source.shape
+    padded = np.full((end - start + 2 * half, samples + 2 * half), np.nan, dtype=np.float32)
+    first, last = max(start - half, 0), min(end + half, lines)
+    padded[first - start + half:last - start + half, half:half + samples] = source[first:last]
+    padded[padded == 0] = np.nan
+    return padded
+
+
+def speckle_filter_kernel(sources, target, start, end, threshold):
+    half = LEE_SIGMA_WINDOW // 2
+    target[start:end] = lee_sigma(read_padded(sources[0], start, end, half), half, threshold)
+
+
+def speckle_filter(source_dim, target_dim, parameters, jobs, tile_rows):
+    if parameters.get("filter") != "Lee Sigma":
+        raise ValueError("The NumPy engine only has the Lee Sigma speckle filter")
+    source = Product(source_dim)
+    bands = source.get_bands()
+    target = source.derive(target_dim, [(name, "intensity") for name in bands], source.width, source.height)
+    for name, img_file in bands.items():
+        target_file = target.get_band_file(name)
+        create_band(target_file, name, source.height, source.width)
+        run_tiled(speckle_filter_kernel, [img_file], target_file, tile_rows, jobs, threshold=get_point_target_threshold(img_file))
+    target.write()
+
+
+# Multilook
+# The mean of each block of range by azimuth looks, leaving out no data, with partial blocks at the edges dropped
+def multilook_kernel(sources, target, start, end, range_looks, azimuth_looks):
+    samples = target.shape[1]
+    block = np.array(sources[0][start * azimuth_looks:end * azimuth_looks, :samples * range_looks], dtype=np.float64)
+    block = block.reshape(end - start, azimuth_looks, samples, range_looks)
+    valid = block != 0
+    count = valid.sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        target[start:end] = np.where(count > 0, block.sum(axis=(1, 3)) / count, 0)
+
+
+# The metadata SNAP's Multilook operator updates: looks, pixel spacing, line timing and the tie point grids
+def update_multilook_metadata(product, range_looks, azimuth_looks):
+    metadata = product.metadata
+    for name, looks in [("range_looks", range_looks), ("azimuth_looks", azimuth_looks)]:
+        set_attribute(metadata, name, float(get_attribute(metadata, name)) * looks)
+    for name, looks in [("range_spacing", range_looks), ("azimuth_spacing", azimuth_looks)]:
+        set_attribute(metadata, name, float(get_attribute(metadata, name)) * looks)
+
+    line_time_interval = float(get_attribute(metadata, "line_time_interval"))
+    set_attribute(metadata, "line_time_interval", line_time_interval * azimuth_looks)
+    first_line_time = datetime.strptime(get_attribute(metadata, "first_line_time"), UTC_FORMAT)
+    first_line_time += timedelta(seconds=line_time_interval * (azimuth_looks - 1) / 2)
+    set_attribute(metadata, "first_line_time", first_line_time.strftime(UTC_FORMAT).upper())
+    set_attribute(metadata, "multilook_flag", 1)
+
+    for grid in product.root.iterfind("Tie_Point_Grids/Tie_Point_Grid_Info"):
+        for axis, looks in [("X", range_looks), ("Y", azimuth_looks)]:
+            for tag in [f"OFFSET_{axis}", f"STEP_{axis}"]:
+                grid.find(tag).text = str(float(grid.findtext(tag)) / looks)
+
+
+def multilook(source_dim, target_dim, parameters, jobs, tile_rows):
+    range_looks, azimuth_looks = int(parameters["nRgLooks"]), int(parameters["nAzLooks"])
+    source = Product(source_dim)
+    bands = source.get_bands()
+    width, height = source.width // range_looks, source.height // azimuth_looks
+    target = source.derive(target_dim, [(name, "intensity") for name in bands], width, height)
+    for name, img_file in bands.items():
+        target_file = target.get_band_file(name)
+        create_band(target_file, name, height, width)
+        run_tiled(multilook_kernel, [img_file], target_file, tile_rows, jobs, range_looks=range_looks, azimuth_looks=azimuth_looks)
+    update_multilook_metadata(target, range_looks, azimuth_looks)
+    target.write()
+
+
+OPERATORS = {
+    "Calibration": calibrate,
+    "Speckle-Filter": speckle_filter,
+    "Multilook": multilook,
+}
+
+
+def run_operator(command, source_dim, target, parameters, jobs, tile_rows):
+    target_dim = f"{target}.dim"
+    OPERATORS[command](source_dim, target_dim, parameters, jobs, tile_rows)
+    return target_dim
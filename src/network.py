@@ -0,0 +1,68 @@
+import asyncio
+from threading import Thread
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+
+EARTHDATA_HOST = "urs.earthdata.nasa.gov"
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Errors a request may fail with and be retried after
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+# An asyncio event loop on its own thread, holding one aiohttp session for all metadata searches and
+# downloads. The connector bounds the connections open at once, overall and to any one host, so callers
+# can start as many requests as they like. Code outside the loop hands it coroutines through run()
+class AsyncNetwork():
+
+    def __init__(self, limit=100, limit_per_host=10, credentials=None, user_agent=None, timeout=60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.auth = aiohttp.BasicAuth(*credentials) if credentials else None
+        self.headers = {"User-Agent": user_agent} if user_agent else {}
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.session = None
+
+    def __enter__(self):
+        self.thread.start()
+        self.session = self.run(self._create_session())
+        return self
+
+    def __exit__(self, *exc_info):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+        # Earthdata Login and the data hosts keep the login in cookies, so it only happens once per session
+        cookie_jar = aiohttp.CookieJar(unsafe=True)
+        return aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar, headers=self.headers, timeout=timeout)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def post_json(self, url, data, headers=None):
+        async with self.session.post(url, data=data, headers=headers) as response:
+            response.raise_for_status()
+            return await response.json(), response.headers
+
+    # Follows redirects itself so the Earthdata credentials are only ever sent to Earthdata Login. The
+    # response is returned open for streaming, to be used with async with
+    async def get(self, url, headers=None):
+        for _ in range(MAX_REDIRECTS):
+            auth = self.auth if urlparse(url).hostname == EARTHDATA_HOST else None
+            response = await self.session.get(url, headers=headers, auth=auth, allow_redirects=False)
+            if response.status not in REDIRECT_STATUSES:
+                if response.status >= 400:
+                    response.release()
+                    response.raise_for_status()
+                return response
+            url = urljoin(str(response.url), response.headers["Location"])
+            response.release()
+        raise aiohttp.TooManyRedirects(response.request_info, response.history)
@@ -0,0 +1,141 @@
+import json
+import os
+import resource
+from contextlib import contextmanager
+from functools import wraps
+from threading import Event, Thread
+from time import time
+
+# Steps append one line each to this file in the working directory of the granule being processed
+PROFILE_FILE = "profile.jsonl"
+# Seconds between readings of the peak memory of a child process
+RSS_SAMPLE_INTERVAL = 0.2
+enabled = False
+
+
+def get_io_bytes():
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def record(name, wall_time, cpu_time, peak_rss, read_bytes, write_bytes, directory="."):
+    if not enabled:
+        return
+    entry = {
+        "stage": name,
+        "wall_time": round(wall_time, 3),
+        "cpu_time": round(cpu_time, 3),
+        "peak_rss": peak_rss,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+    with open(os.path.join(directory, PROFILE_FILE), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+# Resource use of a single child process, as returned by os.wait4. Its ru_maxrss would include the memory of
+# this process at the time of the fork, so the peak memory is what sample_peak_rss saw instead
+def record_child(name, wall_time, rusage, peak_rss):
+    record(name, wall_time, rusage.ru_utime + rusage.ru_stime, peak_rss, rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+
+
+def get_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+# The high water mark of a child's memory starts afresh when it executes the tool, but is gone once it exits,
+# so it is read while the child runs. Growth in the last interval before it exits is missed, and tools that
+# finish within the first interval record no peak at all. Returns a function that stops sampling and gives
+# the peak seen
+def sample_peak_rss(pid):
+    peak_rss = [0]
+    stopped = Event()
+
+    def sample():
+        while True:
+            peak_rss[0] = max(peak_rss[0], get_peak_rss(pid))
+            if stopped.wait(RSS_SAMPLE_INTERVAL):
+                return
+
+    def stop():
+        stopped.set()
+        thread.join()
+        return peak_rss[0]
+
+    thread = Thread(target=sample, daemon=True)
+    thread.start()
+    return stop
+
+
+def get_usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = get_io_bytes()
+    return {
+        "time": time(),
+        "cpu_time": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "peak_rss": own.ru_maxrss * 1024,
+        "read_bytes": read_bytes + children.ru_inblock * 512,
+        "write_bytes": write_bytes + children.ru_oublock * 512,
+    }
+
+
+# Resource use of work done in this process and the children it waits for. The peak RSS is that of the
+# process so far, since the kernel does not reset it between steps. Everything else the process does meanwhile
+# counts too, so work that runs in several threads at once is profiled as one stage around all of it
+@contextmanager
+def stage(name):
+    start = get_usage()
+    try:
+        yield
+    finally:
+        end = get_usage()
+        record(name, end["time"] - start["time"], end["cpu_time"] - start["cpu_time"], end["peak_rss"], end["read_bytes"] - start["read_bytes"], end["write_bytes"] - start["write_bytes"])
+
+
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset(directory="."):
+    profile_file = os.path.join(directory, PROFILE_FILE)
+    if os.path.exists(profile_file):
+        os.unlink(profile_file)
+
+
+def write_report(report_file, granule):
+    if not enabled or not os.path.exists(PROFILE_FILE):
+        return
+    with open(PROFILE_FILE, "r") as f:
+        stages = [json.loads(line) for line in f]
+
+    totals = {}
+    for entry in stages:
+        total = totals.setdefault(entry["stage"], {"count": 0, "wall_time": 0, "cpu_time": 0, "peak_rss": 0, "read_bytes": 0, "write_bytes": 0})
+        total["count"] += 1
+        total["peak_rss"] = max(total["peak_rss"], entry["peak_rss"])
+        for key in ["wall_time", "cpu_time", "read_bytes", "write_bytes"]:
+            total[key] += entry[key]
+
+    report = {"granule": granule, "stages": stages, "totals": totals}
+    print(f"\nWriting processing profile {report_file}")
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    os.unlink(PROFILE_FILE)
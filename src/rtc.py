@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import asyncio
+import json
 import os
 import subprocess
 from argparse import ArgumentParser
@@ -7,17 +9,44 @@ from shutil import rmtree
 from datetime import datetime
 import glob
 import re
+from time import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from copy import copy
+from functools import partial
+from queue import Queue
+from threading import Lock, RLock, Thread, local
 from getpass import getpass
+from urllib.parse import urlparse
 
 # pip3 install
+import aiohttp
+import numpy as np
 import requests
 from shapely.geometry import Polygon
 from jinja2 import Template
 from lxml import etree
+from osgeo import gdal
+import get_dem as get_dem_module
 from get_dem import get_dem
 
+import engine
+import profiling
+from cache import DemCache, FileCache, MetadataStore
+from network import EARTHDATA_HOST, NETWORK_ERRORS, AsyncNetwork
+from profiling import profiled
+
 CHUNK_SIZE = 5242880
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+# Statuses the storage answers with once a presigned download URL has expired
+EXPIRED_URL_STATUSES = (401, 403)
+# How often the progress of a download is made durable, whichever comes first
+CHECKPOINT_BYTES = 64 * 2 ** 20
+CHECKPOINT_SECONDS = 5
 CMR_URL = "https://cmr.earthdata.nasa.gov/search/granules.json"
+CMR_PAGE_SIZE = 2000
 COLLECTION_IDS = [
     "C1214470533-ASF",  # SENTINEL-1A_DUAL_POL_GRD_HIGH_RES
     "C1214471521-ASF",  # SENTINEL-1A_DUAL_POL_GRD_MEDIUM_RES
@@ -31,6 +60,22 @@ COLLECTION_IDS = [
     "C1327985661-ASF",  # SENTINEL-1B_SLC
 ]
 USER_AGENT = "python3 asfdaac/s1tbx-rtc"
+EARTHDATA_TOKEN_URL = f"https://{EARTHDATA_HOST}/api/users/find_or_create_token"
+# Hosts the Earthdata bearer token is sent to, never the storage they redirect downloads to
+TOKEN_HOSTS = {"datapool.asf.alaska.edu"}
+BLOCK_ROWS = 256
+CLEAN_THRESHOLD = .005
+FLOAT32_MAX = 3.4028234663852886e38
+# Backscatter stored as UInt16 covers this range of decibels, with 0 left for no data
+DB_MIN = -50
+DB_MAX = 30
+DB_SCALE = (DB_MAX - DB_MIN) / 65534
+DB_OFFSET = DB_MIN - DB_SCALE
+OVERVIEW_LEVELS = [2, 4, 8, 16]
+fetch_dem_tile = get_dem_module.get_tile_for
+cmr_sessions = local()
+earthdata_session = None
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arcgis_template.xml")
 
 
 # Metadata
@@ -41,8 +86,8 @@ def get_download_url(entry):
     return None
 
 
-def get_polygon(entry):
-    floats = [float(ii) for ii in entry["polygons"][0][0].split()]
+def get_polygon(coordinates):
+    floats = [float(ii) for ii in coordinates.split()]
     points = zip(floats[::2], floats[1::2])
     return Polygon(points)
 
@@ -56,53 +101,466 @@ def get_bounding_box(polygon):
     }
 
 
-def get_metadata(granule):
-    print("\nFetching granule information")
+def validate_metadata(granule, metadata):
+    if metadata is None:
+        return f"Either {granule} does exist or it is not a GRD/SLC product."
+    if metadata["bounding_box"]["lon_min"] < -170 and metadata["bounding_box"]["lon_max"] > 170:
+        return "Granules crossing the antimeridian are not supported."
+    return None
+
 
-    params = {
-        "readable_granule_name": granule,
+def get_granule_record(entry):
+    return {
+        "download_url": get_download_url(entry),
+        "polygon": entry["polygons"][0][0],
+        "size": int(float(entry.get("granule_size", 0)) * 2 ** 20),
+    }
+
+
+def get_cmr_session():
+    if not hasattr(cmr_sessions, "session"):
+        cmr_sessions.session = requests.Session()
+        cmr_sessions.session.headers["User-Agent"] = USER_AGENT
+    return cmr_sessions.session
+
+
+def get_search_params(names):
+    return {
+        "readable_granule_name": sorted(names),
         "provider": "ASF",
-        "collection_concept_id": COLLECTION_IDS
+        "collection_concept_id": COLLECTION_IDS,
+        "page_size": CMR_PAGE_SIZE,
     }
-    response = requests.get(url=CMR_URL, params=params)
-    response.raise_for_status()
-    cmr_data = response.json()
 
-    if not cmr_data["feed"]["entry"]:
-        return None
 
-    entry = cmr_data["feed"]["entry"][0]
-    polygon = get_polygon(entry)
+def add_granule_records(records, names, entries):
+    for entry in entries:
+        for name in [entry.get("producer_granule_id"), entry.get("title", "").split("-")[0]]:
+            if name in names:
+                records.setdefault(name, get_granule_record(entry))
+                break
+
+
+# Search CMR for many granules at once, returning a record for each granule that was found
+def search_granules(granules):
+    session = get_cmr_session()
+    records = {}
+    for start in range(0, len(granules), CMR_PAGE_SIZE):
+        names = set(granules[start:start + CMR_PAGE_SIZE])
+        headers = {}
+        while True:
+            # Posting the form keeps thousands of granule names out of the URL
+            response = session.post(url=CMR_URL, data=get_search_params(names), headers=headers)
+            response.raise_for_status()
+            entries = response.json()["feed"]["entry"]
+            add_granule_records(records, names, entries)
+            search_after = response.headers.get("CMR-Search-After")
+            if len(entries) < CMR_PAGE_SIZE or not search_after:
+                break
+            headers["CMR-Search-After"] = search_after
+    return records
+
+
+async def search_granule_page_async(network, records, names):
+    headers = {}
+    while True:
+        feed, response_headers = await network.post_json(CMR_URL, get_search_params(names), headers)
+        entries = feed["feed"]["entry"]
+        add_granule_records(records, names, entries)
+        search_after = response_headers.get("CMR-Search-After")
+        if len(entries) < CMR_PAGE_SIZE or not search_after:
+            return
+        headers["CMR-Search-After"] = search_after
+
+
+# The same search with every chunk of granule names in flight at once
+async def search_granules_async(network, granules):
+    records = {}
+    chunks = [set(granules[start:start + CMR_PAGE_SIZE]) for start in range(0, len(granules), CMR_PAGE_SIZE)]
+    await asyncio.gather(*[search_granule_page_async(network, records, names) for names in chunks])
+    return records
+
+
+def get_metadata_from_record(record):
+    polygon = get_polygon(record["polygon"])
     return {
-        "download_url": get_download_url(entry),
+        "download_url": record["download_url"],
         "bounding_box": get_bounding_box(polygon),
     }
 
 
-# Write a netrc file
-def write_netrc_file(username, password):
-    netrc_file = os.environ["HOME"] + "/.netrc"
-    with open(netrc_file, "w") as f:
-        f.write(f"machine urs.earthdata.nasa.gov login {username} password {password}")
+# Look up many granules with as few CMR searches as possible, returning None for the ones that were not found
+def get_metadata_bulk(granules, metadata_store=None, network=None):
+    records = metadata_store.get_many(granules) if metadata_store else {}
+    missing = [granule for granule in granules if granule not in records]
+    if missing:
+        found = network.run(search_granules_async(network, missing)) if network else search_granules(missing)
+        if metadata_store:
+            metadata_store.put_many(found)
+        records.update(found)
+    return {granule: get_metadata_from_record(records[granule]) if granule in records else None for granule in granules}
+
+
+@profiled("metadata")
+def get_metadata(granule, metadata_store=None, network=None):
+    print("\nFetching granule information")
+    return get_metadata_bulk([granule], metadata_store, network)[granule]
+
+
+def get_metadata_store(args):
+    if not args.cache_dir:
+        return None
+    os.makedirs(args.cache_dir, exist_ok=True)
+    return MetadataStore(os.path.join(args.cache_dir, "metadata.sqlite"), args.metadata_ttl * 3600)
+
+
+# Earthdata Login
+# A session that sends the credentials to Earthdata Login only, never to the data hosts it redirects back
+# to. It logs in once, asking for a bearer token for the data hosts, and keeps the cookies of the redirect
+# flow, so later downloads in the same process go straight to the data. The token is added to each request
+# for a host in TOKEN_HOSTS rather than to the session headers, so it never reaches the storage that
+# downloads are redirected to, even when later range requests go there directly
+class EarthdataSession(requests.Session):
+
+    def __init__(self, username, password):
+        super().__init__()
+        self.headers["User-Agent"] = USER_AGENT
+        self.credentials = (username, password)
+        self.token = None
+        self.login_lock = Lock()
+        self.logged_in = False
+
+    def login(self):
+        with self.login_lock:
+            if self.logged_in:
+                return
+            try:
+                response = self.post(EARTHDATA_TOKEN_URL, auth=self.credentials, timeout=DOWNLOAD_TIMEOUT)
+                response.raise_for_status()
+                self.token = response.json()["access_token"]
+            except (requests.RequestException, KeyError, ValueError) as e:
+                print(f"Could not get an Earthdata Login token, logging in through redirects instead: {e}")
+            self.logged_in = True
+
+    def prepare_request(self, request):
+        prepared_request = super().prepare_request(request)
+        self._add_token(prepared_request)
+        return prepared_request
+
+    # Called by requests on every redirect, after it has dropped the Authorization header for a new host
+    def rebuild_auth(self, prepared_request, response):
+        super().rebuild_auth(prepared_request, response)
+        if urlparse(prepared_request.url).hostname == EARTHDATA_HOST:
+            prepared_request.prepare_auth(self.credentials)
+        self._add_token(prepared_request)
+
+    def _add_token(self, prepared_request):
+        if self.token and urlparse(prepared_request.url).hostname in TOKEN_HOSTS:
+            prepared_request.headers["Authorization"] = f"Bearer {self.token}"
+
+
+def set_earthdata_credentials(username, password):
+    global earthdata_session
+    earthdata_session = EarthdataSession(username, password)
+
+
+# Logs in on first use. Batch processing logs in before starting the worker processes that download, so
+# they inherit the token and cookies instead of each logging in again
+def get_earthdata_session():
+    earthdata_session.login()
+    return earthdata_session
 
 
 # Download the granule file
-def download_file(url):
+@profiled("download")
+def download_file(url, connections=1, cache=None):
     print(f"\nDownloading granule from {url}")
     local_filename = url.split("/")[-1]
-    headers = {"User-Agent": USER_AGENT}
-    with requests.get(url, headers=headers, stream=True) as r:
+    # Probe with a one byte range; servers without range support answer with the whole file
+    headers = {"Range": "bytes=0-0"}
+    with get_earthdata_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
         r.raise_for_status()
-        with open(local_filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
+        size, etag, checksum = get_remote_file_info(r.status_code, r.headers)
+        if cache and checksum and cache.fetch(local_filename, checksum, local_filename):
+            print(f"Using cached copy of {local_filename}")
+            return local_filename
+
+        # Written beside the file and moved over it, since it may be a hard link into the cache
+        if r.status_code != 206:
+            with open(f"{local_filename}.part", "wb") as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+            os.replace(f"{local_filename}.part", local_filename)
+        download_url = r.url
+
+    if r.status_code == 206:
+        PartialDownload(url, download_url, local_filename, size, etag).download(connections)
+    if cache and checksum:
+        cache.store(local_filename, local_filename, checksum)
     return local_filename
 
 
+def get_remote_file_info(status, headers):
+    if status == 206:
+        size = int(headers["Content-Range"].split("/")[-1])
+    else:
+        size = int(headers.get("Content-Length", 0))
+    # The ETag is the server's checksum of the file, so a cached copy is only reused if it still matches
+    etag = headers.get("ETag")
+    checksum = (size, etag) if etag else None
+    return size, etag, checksum
+
+
+# The same download on the event loop of the network, into a directory other than the working one. Disk
+# writes go to the default executor so they do not hold up other requests
+async def download_file_async(network, url, directory, connections=1, cache=None):
+    print(f"\nDownloading granule from {url}")
+    loop = asyncio.get_event_loop()
+    name = url.split("/")[-1]
+    local_filename = os.path.join(directory, name)
+    async with await network.get(url, {"Range": "bytes=0-0"}) as r:
+        size, etag, checksum = get_remote_file_info(r.status, r.headers)
+        if cache and checksum and await loop.run_in_executor(None, cache.fetch, name, checksum, local_filename):
+            print(f"Using cached copy of {name}")
+            return local_filename
+
+        if r.status != 206:
+            with open(f"{local_filename}.part", "wb") as f:
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+            os.replace(f"{local_filename}.part", local_filename)
+        download_url = str(r.url)
+
+    if r.status == 206:
+        await PartialDownload(url, download_url, local_filename, size, etag).download_async(network, connections)
+    if cache and checksum:
+        await loop.run_in_executor(None, cache.store, local_filename, name, checksum)
+    return local_filename
+
+
+def get_network(args):
+    if not args.async_network:
+        return None
+    return AsyncNetwork(args.connection_limit, args.host_connection_limit, (args.username, args.password), USER_AGENT, DOWNLOAD_TIMEOUT)
+
+
+def get_granule_cache(args):
+    if not args.cache_dir:
+        return None
+    return FileCache(os.path.join(args.cache_dir, "granules"), args.cache_size * 2 ** 30)
+
+
+def get_byte_ranges(size, count):
+    range_size = -(-size // count)
+    return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+
+# Downloads go to a .part file with a sidecar recording how far each byte range got, so an interrupted
+# download picks up where it stopped as long as the size and ETag of the remote file are unchanged. The
+# ranges are fetched from the URL the data host redirected to, and the data host is asked for a new one
+# when that expires
+class PartialDownload():
+
+    def __init__(self, source_url, url, local_filename, size, etag):
+        self.source_url = source_url
+        self.url = url
+        self.url_lock = Lock()
+        self.local_filename = local_filename
+        self.part_file = f"{local_filename}.part"
+        self.state_file = f"{self.part_file}.json"
+        self.size = size
+        self.etag = etag
+        self.lock = RLock()
+        self.fd = None
+        self.ranges = None
+        self.unsaved_bytes = 0
+        self.saved_time = time()
+
+    def download(self, connections):
+        self._open(connections)
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = [executor.submit(self._download_range, byte_range) for byte_range in self.ranges]
+                for future in futures:
+                    future.result()
+        finally:
+            self._checkpoint()
+            os.close(self.fd)
+        self._finish()
+
+    async def download_async(self, network, connections):
+        self.url_lock = asyncio.Lock()
+        self._open(connections)
+        try:
+            await asyncio.gather(*[self._download_range_async(network, byte_range) for byte_range in self.ranges])
+        finally:
+            self._checkpoint()
+            os.close(self.fd)
+        self._finish()
+
+    def _open(self, connections):
+        flags = os.O_RDWR | os.O_CREAT
+        self.ranges = self._load_ranges()
+        if self.ranges is None:
+            self.ranges = [[start, end, start] for start, end in get_byte_ranges(self.size, connections)]
+            flags |= os.O_TRUNC
+        else:
+            fetched = sum(offset - start for start, end, offset in self.ranges)
+            print(f"Resuming download with {fetched} of {self.size} bytes already fetched")
+
+        print(f"Fetching {self.size} bytes over {min(connections, len(self.ranges))} connections")
+        self.fd = os.open(self.part_file, flags, 0o644)
+        try:
+            os.posix_fallocate(self.fd, 0, self.size)
+            self._save_ranges()
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _finish(self):
+        os.rename(self.part_file, self.local_filename)
+        os.unlink(self.state_file)
+
+    def _load_ranges(self):
+        if not (os.path.exists(self.part_file) and os.path.exists(self.state_file)):
+            return None
+        with open(self.state_file, "r") as f:
+            state = json.load(f)
+        if state["url"] != self.source_url or state["size"] != self.size or state["etag"] != self.etag:
+            return None
+        return state["ranges"]
+
+    def _save_ranges(self, ranges=None):
+        state = {"url": self.source_url, "size": self.size, "etag": self.etag, "ranges": ranges or self.ranges}
+        with open(f"{self.state_file}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self.state_file}.tmp", self.state_file)
+
+    # Each range is retried on its own, picking up from the last byte written
+    def _download_range(self, byte_range):
+        start, end, offset = byte_range
+        url = self.url
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            if offset > end:
+                return
+            headers = {"Range": f"bytes={offset}-{end}"}
+            try:
+                with get_earthdata_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise IOError(f"Server ignored range request for bytes {offset}-{end}")
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        offset = self._write_chunk(byte_range, chunk, offset)
+            except (requests.RequestException, IOError) as e:
+                print(f"Download of bytes {offset}-{end} failed on attempt {attempt}: {e}")
+                if isinstance(e, requests.HTTPError) and e.response.status_code in EXPIRED_URL_STATUSES:
+                    url = self._refresh_url(url)
+        if offset <= end:
+            raise IOError(f"Could not download bytes {offset}-{end} of {self.local_filename}")
+
+    async def _download_range_async(self, network, byte_range):
+        start, end, offset = byte_range
+        url = self.url
+        loop = asyncio.get_event_loop()
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            if offset > end:
+                return
+            try:
+                async with await network.get(url, {"Range": f"bytes={offset}-{end}"}) as r:
+                    if r.status != 206:
+                        raise IOError(f"Server ignored range request for bytes {offset}-{end}")
+                    async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                        offset = await loop.run_in_executor(None, self._write_chunk, byte_range, chunk, offset)
+            except NETWORK_ERRORS + (IOError,) as e:
+                print(f"Download of bytes {offset}-{end} failed on attempt {attempt}: {e}")
+                if isinstance(e, aiohttp.ClientResponseError) and e.status in EXPIRED_URL_STATUSES:
+                    url = await self._refresh_url_async(network, url)
+        if offset <= end:
+            raise IOError(f"Could not download bytes {offset}-{end} of {self.local_filename}")
+
+    # Ranges refused together ask the data host for a new URL once, the first to get the lock
+    def _refresh_url(self, expired_url):
+        with self.url_lock:
+            if self.url == expired_url:
+                try:
+                    with get_earthdata_session().get(self.source_url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                        r.raise_for_status()
+                        self.url = r.url
+                except requests.RequestException as e:
+                    print(f"Could not get a new download URL from {self.source_url}: {e}")
+            return self.url
+
+    async def _refresh_url_async(self, network, expired_url):
+        async with self.url_lock:
+            if self.url == expired_url:
+                try:
+                    async with await network.get(self.source_url, {"Range": "bytes=0-0"}) as r:
+                        self.url = str(r.url)
+                except NETWORK_ERRORS as e:
+                    print(f"Could not get a new download URL from {self.source_url}: {e}")
+            return self.url
+
+    def _write_chunk(self, byte_range, chunk, offset):
+        offset += os.pwrite(self.fd, chunk, offset)
+        with self.lock:
+            byte_range[2] = offset
+            self.unsaved_bytes += len(chunk)
+            if self.unsaved_bytes >= CHECKPOINT_BYTES or time() - self.saved_time >= CHECKPOINT_SECONDS:
+                self._checkpoint()
+        return offset
+
+    # Syncing is slow on network volumes, so progress is only saved now and then and an interrupted download
+    # fetches again what came after. The ranges are taken before syncing, so they only cover bytes that are
+    # safely on disk
+    def _checkpoint(self):
+        with self.lock:
+            ranges = [list(byte_range) for byte_range in self.ranges]
+            os.fdatasync(self.fd)
+            self._save_ranges(ranges)
+            self.unsaved_bytes = 0
+            self.saved_time = time()
+
+
 # Get the DEM
-def get_dem_file(bounding_box):
+def get_cached_dem_tile(dem_cache, args):
+    dem_type, tile = args
+    tile_file = f"DEM/{tile}.tif"
+    if not dem_cache.fetch_tile(dem_type, tile, tile_file):
+        fetch_dem_tile(args)
+        dem_cache.store_tile(tile_file, dem_type, tile)
+
+
+# The mosaic get_dem wrote, and the VRT SNAP reads it through
+def get_dem_files(dem_name):
+    return f"{dem_name}.tif", f"{dem_name}.vrt"
+
+
+# SNAP is handed the DEM as Int16. The VRT converts the mosaic as it is read, so the mosaic is only written once
+def create_int16_vrt(raster_file, vrt_file):
+    gdal.ErrorReset()
+    dataset = gdal.Translate(vrt_file, raster_file, format="VRT", outputType=gdal.GDT_Int16)
+    if dataset is None:
+        raise IOError(f"Could not create {vrt_file}: {gdal.GetLastErrorMsg()}")
+    dataset = None
+    check_gdal_errors(f"write {vrt_file}")
+
+
+@profiled("dem")
+def get_dem_file(bounding_box, dem_cache=None):
     print("\nPreparing digital elevation model")
+    if dem_cache:
+        dem_name = dem_cache.fetch_mosaic(bounding_box)
+        if dem_name:
+            print(f"Using cached {dem_name} mosaic")
+            raster_file, vrt_file = get_dem_files(dem_name)
+            create_int16_vrt(raster_file, vrt_file)
+            return dem_name, vrt_file
+        # get_dem fetches each tile through this hook, in worker processes of its own
+        get_dem_module.get_tile_for = partial(get_cached_dem_tile, dem_cache)
+    else:
+        get_dem_module.get_tile_for = fetch_dem_tile
+
     temp_file = "temp_dem"
     dem_name = get_dem(bounding_box["lon_min"], bounding_box["lat_min"], bounding_box["lon_max"], bounding_box["lat_max"], temp_file, True, 30)
     cleanup("temp.vrt")
@@ -111,15 +569,41 @@ def get_dem_file(bounding_box):
     if "NED" in dem_name:
         cleanup("temp_dem_wgs84.tif")
     rmtree("DEM")
-    system_call(["gdal_translate", "-ot", "Int16", temp_file, dem_name])
-    cleanup(temp_file)
-    return dem_name
+    # A mosaic of the same name left by an earlier run may be a hard link into the cache, so it is replaced
+    # rather than written over
+    raster_file, vrt_file = get_dem_files(dem_name)
+    os.replace(temp_file, raster_file)
+    create_int16_vrt(raster_file, vrt_file)
+    if dem_cache:
+        dem_cache.store_mosaic(raster_file, dem_name, bounding_box)
+    return dem_name, vrt_file
+
+
+def get_dem_cache(args):
+    if not args.cache_dir:
+        return None
+    return DemCache(os.path.join(args.cache_dir, "dem"), args.dem_cache_size * 2 ** 30)
+
+
+def get_dem_source(dem_source, bounding_box, dem_cache=None):
+    if dem_source == "ASF":
+        return get_dem_file(bounding_box, dem_cache)
+    return "SRTM 1Sec Hgt", None
 
 
 # Code used a little everywhere
 def system_call(params):
     print(" ".join(params))
-    return_code = subprocess.call(params)
+    start = time()
+    # Popen returns once the child has executed the tool, so the memory sampled is the tool's own
+    process = subprocess.Popen(params)
+    stop_sampling = profiling.sample_peak_rss(process.pid)
+    # Reap the child ourselves to get its own resource usage
+    _, status, rusage = os.wait4(process.pid, 0)
+    peak_rss = stop_sampling()
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    profiling.record_child(params[0] if params[0] != "gpt" else f"gpt {params[1]}", time() - start, rusage, peak_rss)
+    return_code = process.returncode
     if return_code:
         exit(return_code)
 
@@ -131,15 +615,358 @@ def cleanup(input_file):
         rmtree(data_dir)
 
 
-def gpt(input_file, command, *args, dem_parameters=None, cleanup_flag=True):
+def gpt(input_file, command, *args, dem_parameters=None, cleanup_flag=True, target=None):
     print(f"\n{command}")
     if dem_parameters is None:
         dem_parameters = []
-    system_command = ["gpt", command, f"-Ssource={input_file}", "-t", command] + list(args) + dem_parameters
+    if target is None:
+        target = command
+    system_command = ["gpt", command, f"-Ssource={input_file}", "-t", target] + list(args) + dem_parameters
     system_call(system_command)
     if cleanup_flag:
         cleanup(input_file)
-    return f"{command}.dim"
+    return f"{target}.dim"
+
+
+# Operator parameters differ between SNAP releases, and gpt lists the ones an operator has in its help
+def has_gpt_parameter(command, parameter):
+    result = subprocess.run(["gpt", command, "-h"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return f"-P{parameter}=" in result.stdout
+
+
+# GeoTIFF output
+def get_physical_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+# Threads for each band, so that the bands converted at once share the cores between them
+def get_gdal_threads(gdal_threads, band_jobs):
+    return gdal_threads or max(1, (os.cpu_count() or 1) // band_jobs)
+
+
+# The block cache and the overview threads are process wide settings of GDAL
+def configure_gdal(threads, cache_max=None):
+    gdal.SetCacheMax((cache_max or get_physical_memory() // 8 // 2 ** 20) * 2 ** 20)
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(threads))
+
+
+OutputOptions = namedtuple("OutputOptions", ["output_format", "output_type", "compression", "max_z_error", "block_size", "resampling", "predictor", "zlevel", "threads"])
+
+
+def get_output_options(args):
+    threads = get_gdal_threads(args.gdal_threads, args.band_jobs)
+    return OutputOptions(args.output_format, args.output_type, args.compression, args.max_z_error, args.block_size, args.overview_resampling, args.predictor, args.zlevel, threads)
+
+
+# Floating point prediction only applies to floating point data, such as the backscatter bands
+def get_predictor(options, data_type):
+    if options.predictor == 3 and data_type not in (gdal.GDT_Float32, gdal.GDT_Float64):
+        return 2
+    return options.predictor
+
+
+def get_creation_options(options, data_type):
+    creation_options = [f"COMPRESS={options.compression}", f"NUM_THREADS={options.threads}"]
+    if options.output_format == "COG":
+        creation_options += [f"BLOCKSIZE={options.block_size}", f"RESAMPLING={options.resampling}"]
+    else:
+        creation_options += ["TILED=YES", f"BLOCKXSIZE={options.block_size}", f"BLOCKYSIZE={options.block_size}"]
+
+    # LERC does its own prediction
+    if options.compression != "LERC":
+        predictor = get_predictor(options, data_type)
+        if options.output_format == "COG":
+            predictor = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}[predictor]
+        creation_options.append(f"PREDICTOR={predictor}")
+    if options.compression == "LERC":
+        creation_options.append(f"MAX_Z_ERROR={options.max_z_error}")
+    if options.compression == "DEFLATE":
+        creation_options.append(f"{'LEVEL' if options.output_format == 'COG' else 'ZLEVEL'}={options.zlevel}")
+    return creation_options
+
+
+# A virtual copy of a SNAP band with zero as no data. When cleaning, a lookup table maps everything up to the
+# threshold to zero and leaves larger values as they are
+def get_virtual_band(source, input_file, clean=False):
+    data_type = source.GetRasterBand(1).DataType
+    dataset = gdal.GetDriverByName("VRT").Create("", source.RasterXSize, source.RasterYSize, 0)
+    dataset.SetGeoTransform(source.GetGeoTransform())
+    dataset.SetProjection(source.GetProjection())
+    dataset.SetMetadata(source.GetMetadata())
+    dataset.AddBand(data_type)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+
+    source_xml = f"<SourceFilename relativeToVRT=\"0\">{os.path.abspath(input_file)}</SourceFilename><SourceBand>1</SourceBand>"
+    if clean:
+        above = CLEAN_THRESHOLD * (1 + 1e-7)
+        lut = f"{-FLOAT32_MAX}:0,{CLEAN_THRESHOLD}:0,{above}:{above},{FLOAT32_MAX}:{FLOAT32_MAX}"
+        band.SetMetadataItem("source_0", f"<ComplexSource>{source_xml}<LUT>{lut}</LUT></ComplexSource>", "new_vrt_sources")
+    else:
+        band.SetMetadataItem("source_0", f"<SimpleSource>{source_xml}</SimpleSource>", "new_vrt_sources")
+    return dataset
+
+
+# Backscatter in decibels as UInt16 values, to be read back as value * DB_SCALE + DB_OFFSET
+def to_decibel_values(data):
+    valid = data > 0
+    values = np.zeros(data.shape, dtype=np.uint16)
+    decibels = 10 * np.log10(data[valid])
+    values[valid] = np.clip(np.rint((decibels - DB_OFFSET) / DB_SCALE), 1, 65535)
+    return values
+
+
+# GDAL reports write errors through return codes and its error state rather than exceptions, which would
+# also change how hyp3-lib sees GDAL. The error state is per thread, so bands written at once keep their own
+def check_gdal(result, action):
+    if result != gdal.CE_None:
+        raise IOError(f"Could not {action}: {gdal.GetLastErrorMsg()}")
+
+
+# Closing a dataset writes out what is left in the block cache, which is reported only in the error state
+def check_gdal_errors(action):
+    if gdal.GetLastErrorType() >= gdal.CE_Failure:
+        raise IOError(f"Could not {action}: {gdal.GetLastErrorMsg()}")
+
+
+def create_geotiff(output_file, source, data_type, creation_options):
+    target = gdal.GetDriverByName("GTiff").Create(output_file, source.RasterXSize, source.RasterYSize, 1, data_type, creation_options)
+    if target is None:
+        raise IOError(f"Could not create {output_file}")
+    target.SetGeoTransform(source.GetGeoTransform())
+    target.SetProjection(source.GetProjection())
+    target.SetMetadata(source.GetMetadata())
+    target.GetRasterBand(1).SetNoDataValue(0)
+    return target
+
+
+# Stream a band into another block by block, setting very small values to no data when cleaning and
+# converting to decibels when quantizing
+def copy_blocks(source_band, target_band, clean=False, quantize=False):
+    x_size, y_size = source_band.XSize, source_band.YSize
+    for y_offset in range(0, y_size, BLOCK_ROWS):
+        data = source_band.ReadAsArray(0, y_offset, x_size, min(BLOCK_ROWS, y_size - y_offset))
+        if data is None:
+            raise IOError(f"Could not read rows {y_offset} to {y_offset + BLOCK_ROWS} of a {x_size}x{y_size} band: {gdal.GetLastErrorMsg()}")
+        if clean:
+            data[data <= CLEAN_THRESHOLD] = 0
+        if quantize:
+            data = to_decibel_values(data)
+        check_gdal(target_band.WriteArray(data, 0, y_offset), f"write rows {y_offset} to {y_offset + BLOCK_ROWS} of a {x_size}x{y_size} band")
+
+
+def get_block_options(options):
+    return ["TILED=YES", f"BLOCKXSIZE={options.block_size}", f"BLOCKYSIZE={options.block_size}", "BIGTIFF=IF_SAFER"]
+
+
+# An uncompressed copy of a band with its overviews, to copy into the output with the overviews as they are
+def create_overview_source(source, temp_file, options, clean=False):
+    temp = create_geotiff(temp_file, source, source.GetRasterBand(1).DataType, get_block_options(options))
+    copy_blocks(source.GetRasterBand(1), temp.GetRasterBand(1), clean)
+    check_gdal(temp.BuildOverviews(options.resampling, OVERVIEW_LEVELS), f"build overviews of {temp_file}")
+    return temp
+
+
+# The same in decibels as UInt16. The overviews are resampled from power, like those of Float32 output, and
+# then converted level by level into overviews created empty in the UInt16 copy
+def create_decibel_source(source, temp_file, options, clean=False):
+    power_file = f"{temp_file}.power.tif"
+    power = create_overview_source(source, power_file, options, clean)
+    decibels = create_geotiff(temp_file, source, gdal.GDT_UInt16, get_block_options(options))
+    check_gdal(decibels.BuildOverviews("NONE", OVERVIEW_LEVELS), f"create overviews of {temp_file}")
+
+    power_band, decibel_band = power.GetRasterBand(1), decibels.GetRasterBand(1)
+    copy_blocks(power_band, decibel_band, quantize=True)
+    for level in range(power_band.GetOverviewCount()):
+        copy_blocks(power_band.GetOverview(level), decibel_band.GetOverview(level), quantize=True)
+    decibel_band.SetScale(DB_SCALE)
+    decibel_band.SetOffset(DB_OFFSET)
+    decibel_band.SetUnitType("dB")
+
+    gdal.ErrorReset()
+    decibels.FlushCache()
+    check_gdal_errors(f"write {temp_file}")
+    power = None
+    gdal.GetDriverByName("GTiff").Delete(power_file)
+    return decibels
+
+
+def copy_to_output(driver_name, output_file, source, creation_options):
+    gdal.ErrorReset()
+    target = gdal.GetDriverByName(driver_name).CreateCopy(output_file, source, options=creation_options)
+    if target is None:
+        raise IOError(f"Could not create {output_file}: {gdal.GetLastErrorMsg()}")
+    target = None
+    check_gdal_errors(f"write {output_file}")
+
+
+# A tiled, compressed GeoTIFF with its internal overviews ahead of the full resolution data, so readers of
+# byte ranges find them first. Overviews can only be laid out that way when copying a file that already has
+# them, so they are built in an uncompressed temporary file first
+def write_tiled_geotiff(source, output_file, temp_file, options, clean=False, quantize=False):
+    if quantize:
+        temp = create_decibel_source(source, temp_file, options, clean)
+    else:
+        temp = create_overview_source(source, temp_file, options, clean)
+    data_type = temp.GetRasterBand(1).DataType
+    copy_to_output("GTiff", output_file, temp, get_creation_options(options, data_type) + ["COPY_SRC_OVERVIEWS=YES"])
+    temp = None
+    gdal.GetDriverByName("GTiff").Delete(temp_file)
+
+
+# The COG driver lays out the overviews ahead of the full resolution data for range reads. Its input is a
+# virtual band, so the cleaned raster is never written out on its own, except when quantizing, which needs
+# an uncompressed UInt16 copy at half the size of the SNAP band whose overviews the driver uses as they are
+def write_cog(source, input_file, output_file, temp_file, options, clean=False, quantize=False):
+    if quantize:
+        cog_source = create_decibel_source(source, temp_file, options, clean)
+    else:
+        cog_source = get_virtual_band(source, input_file, clean)
+
+    data_type = cog_source.GetRasterBand(1).DataType
+    copy_to_output("COG", output_file, cog_source, get_creation_options(options, data_type))
+    cog_source = None
+    if quantize:
+        gdal.GetDriverByName("GTiff").Delete(temp_file)
+
+
+# The uncompressed temporary files go to temp_dir rather than beside the output, which may be on a network
+# volume that others are reading
+def write_geotiff(input_file, output_file, options, clean=False, quantize=False, temp_dir="."):
+    source = gdal.Open(input_file)
+    if source is None:
+        raise IOError(f"Could not open {input_file}")
+    temp_file = os.path.join(temp_dir, f"{os.path.basename(output_file)}.tmp.tif")
+    # A partly written GeoTIFF must not be taken for output
+    try:
+        if options.output_format == "COG":
+            write_cog(source, input_file, output_file, temp_file, options, clean, quantize)
+        else:
+            write_tiled_geotiff(source, output_file, temp_file, options, clean, quantize)
+    except Exception:
+        for partial_file in [output_file, temp_file, f"{temp_file}.power.tif"]:
+            if os.path.exists(partial_file):
+                os.unlink(partial_file)
+        raise
+    source = None
+
+
+# SNAP graphs
+def get_graph_parameters(args):
+    parameters = {}
+    for arg in args:
+        key, value = arg[len("-P"):].split("=", 1)
+        parameters[key] = value.strip("'")
+    return parameters
+
+
+class Graph():
+
+    def __init__(self):
+        self.root = etree.Element("graph", id="Graph")
+        etree.SubElement(self.root, "version").text = "1.0"
+
+    def add_node(self, node_id, operator, sources=(), parameters=None):
+        node = etree.SubElement(self.root, "node", id=node_id)
+        etree.SubElement(node, "operator").text = operator
+        node_sources = etree.SubElement(node, "sources")
+        for source in sources:
+            etree.SubElement(node_sources, "sourceProduct", refid=source)
+        node_parameters = etree.SubElement(node, "parameters")
+        for key, value in (parameters or {}).items():
+            etree.SubElement(node_parameters, key).text = str(value)
+        return node_id
+
+    def write(self, graph_file):
+        with open(graph_file, "wb") as f:
+            f.write(etree.tostring(self.root, pretty_print=True, xml_declaration=True, encoding="UTF-8"))
+        return graph_file
+
+
+# Scratch space
+def get_product_size(product):
+    size = os.path.getsize(product)
+    if product.endswith(".dim"):
+        for root, dirs, files in os.walk(product.replace(".dim", ".data")):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+
+def get_directory_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+    return size
+
+
+# Places intermediate products on RAM-backed storage while they fit its budget, which is shared by all
+# granules using it, and on the scratch directory otherwise
+class ScratchSpace():
+
+    def __init__(self, granule, scratch_dir=None, memory_dir=None, memory_budget=0):
+        self.disk_dir = os.path.join(scratch_dir, granule) if scratch_dir else "."
+        self.memory_root = memory_dir
+        self.memory_dir = os.path.join(memory_dir, granule) if memory_dir else None
+        self.memory_budget = memory_budget
+
+    def get_target(self, name, estimated_size):
+        directory = self.disk_dir
+        if self.memory_budget and get_directory_size(self.memory_root) + estimated_size <= self.memory_budget:
+            directory = self.memory_dir
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def remove(self):
+        for directory in [self.disk_dir, self.memory_dir]:
+            if directory and directory != "." and os.path.isdir(directory):
+                rmtree(directory)
+
+
+# Checkpoints
+# Records each completed stage of a granule with the parameters it ran with and the products it wrote, so a
+# rerun after a failure can pick up from the last completed stage
+class StageManifest():
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.stages = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                self.stages = json.load(f)
+
+    # The products of a stage completed with the same parameters, or None
+    def get(self, name, parameters):
+        stage = self.stages.get(name)
+        if stage is None or stage["parameters"] != parameters:
+            return None
+        return stage["products"]
+
+    def complete(self, name, parameters, products):
+        self.stages[name] = {"parameters": parameters, "products": products}
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        with open(f"{self.manifest_file}.tmp", "w") as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(f"{self.manifest_file}.tmp", self.manifest_file)
+
+    def remove(self):
+        if os.path.exists(self.manifest_file):
+            os.unlink(self.manifest_file)
+
+
+# A step of the processing chain: source and target are the names of the products it reads and writes
+Step = namedtuple("Step", ["target", "command", "args", "source", "use_dem"])
+
+# Rough size of the product a step writes relative to the one it reads, used to pick where it goes
+STEP_SIZE_FACTORS = {
+    "Apply-Orbit-File": 2,
+    "Calibration": 2,
+    "SAR-Simulation": 1.5,
+    "Terrain-Correction": 1.5,
+}
 
 
 class ProcessGranule():
@@ -149,10 +976,24 @@ class ProcessGranule():
         self.has_layover = args.has_layover
         self.has_incidence_angle = args.has_incidence_angle
         self.clean = args.clean
+        self.band_jobs = args.band_jobs
+        self.output_options = get_output_options(args)
+        self.gdal_cache_max = args.gdal_cache_max
+        self.use_graph = args.use_graph
+        self.combined_terrain_correction = args.combined_terrain_correction
+        self.image_resampling = args.image_resampling
+        self.engine_steps = {command for command, backend in [("Calibration", args.calibration), ("Speckle-Filter", args.speckle_filter), ("Multilook", args.multilook)] if backend == "numpy"}
+        self.range_looks = args.range_looks
+        self.azimuth_looks = args.azimuth_looks
+        self.engine_jobs = args.engine_jobs
+        self.tile_rows = args.tile_rows
         self.dem_file = dem_file
         self.dem_name = dem_name
         self.projection = "AUTO:42001"
-        self.output_dir = f"/output"
+        self.output_dir = args.output_dir
+        self.scratch = ScratchSpace(self.granule, args.scratch_dir, args.memory_scratch_dir, args.memory_scratch_size * 2 ** 30)
+        # Kept with the intermediate products, so it survives as long as they do
+        self.manifest = StageManifest(os.path.join(self.scratch.disk_dir, f"{self.granule}_manifest.json"))
 
         if self.dem_file:
             self.dem_parameters = ["-PdemName='External DEM'", f"-PexternalDEMFile={self.dem_file}", "-PexternalDEMNoDataValue=-32767"]
@@ -160,62 +1001,214 @@ class ProcessGranule():
             self.dem_parameters = [f"-PdemName={self.dem_name}"]
 
     def process_granule(self, local_file):
-        local_file = gpt(local_file, "Apply-Orbit-File")
-        local_file = gpt(local_file, "Calibration", "-PoutputBetaBand=true", "-PoutputSigmaBand=false")
+        dim_files = self.run_snap(local_file)
+        self.create_output_files(dim_files)
 
-        range_looks = 3
-        if "_SLC__" in self.granule:
-            range_looks = 12
-            local_file = gpt(local_file, "TOPSAR-Deburst")
+    # Whether the downloaded granule is still needed, which it is not once a rerun can start from a later stage
+    def needs_input(self):
+        steps, outputs = self._get_steps()
+        if self.use_graph:
+            return self._get_graph_products(steps, outputs) is None
+        return steps[0].target in self._get_pending_steps(steps, outputs)
+
+    # Run the SNAP processing chain, returning the terrain corrected products
+    def run_snap(self, local_file):
+        steps, outputs = self._get_steps()
+        if self.use_graph:
+            dim_files = self._get_graph_products(steps, outputs) or self._run_graph(local_file, steps, outputs)
+        else:
+            dim_files = self._run_steps(local_file, steps, outputs)
 
-        local_file = gpt(local_file, "Speckle-Filter", "-Pfilter=Lee Sigma")
-        local_file = gpt(local_file, "Multilook", f"-PnRgLooks={range_looks}", "-PnAzLooks=3")
-        terrain_flattening_file = gpt(local_file, "Terrain-Flattening", "-PreGridMethod=False", dem_parameters=self.dem_parameters)
+        if self.dem_file:
+            for dem_file in get_dem_files(self.dem_name):
+                cleanup(dem_file)
+        return dim_files
 
-        if self.has_layover:
-            local_file = gpt(terrain_flattening_file, "SAR-Simulation", "-PsaveLayoverShadowMask=true", dem_parameters=self.dem_parameters, cleanup_flag=False)
-            local_file = gpt(local_file, "Terrain-Correction", f"-PmapProjection={self.projection}", "-PimgResamplingMethod=NEAREST_NEIGHBOUR", "-PpixelSpacingInMeter=30.0", "-PsourceBands=layover_shadow_mask", dem_parameters=self.dem_parameters)
-            self._process_img_files(local_file)
+    def create_output_files(self, dim_files):
+        img_files = []
+        for dim_file in dim_files:
+            img_files.extend(glob.glob(f"{dim_file.replace('.dim', '.data')}/*.img"))
 
-        local_file = gpt(terrain_flattening_file, "Terrain-Correction", "-PpixelSpacingInMeter=30.0", f"-PmapProjection={self.projection}", f"-PsaveProjectedLocalIncidenceAngle={self.has_incidence_angle}", dem_parameters=self.dem_parameters)
+        configure_gdal(self.output_options.threads, self.gdal_cache_max)
+        # The bands are independent of each other and GDAL releases the GIL while compressing them. Resource
+        # use is process wide, so the bands are profiled together
+        with profiling.stage("geotiff"), ThreadPoolExecutor(max_workers=max(1, min(self.band_jobs, len(img_files)))) as executor:
+            for future in [executor.submit(self._process_img_file, img_file) for img_file in img_files]:
+                future.result()
 
-        if self.dem_file:
-            cleanup(self.dem_file)
-        self._process_img_files(local_file)
+        # The SNAP products are kept until every band has been written, so a rerun can convert them again
+        for dim_file in dim_files:
+            cleanup(dim_file)
+        self.scratch.remove()
         self._create_arcgis_xml()
+        profiling.write_report(f"{self.output_dir}/{self.granule}_profile.json", self.granule)
+        self.manifest.remove()
 
-    def _process_img_files(self, dim_file):
-        data_dir = dim_file.replace(".dim", ".data")
-        for img_file in glob.glob(f"{data_dir}/*.img"):
-            self._process_img_file(img_file)
-        cleanup(dim_file)
+    def _get_steps(self):
+        range_looks = self._get_range_looks()
+        steps = [
+            Step("Apply-Orbit-File", "Apply-Orbit-File", [], None, False),
+            Step("Calibration", "Calibration", ["-PoutputBetaBand=true", "-PoutputSigmaBand=false"], "Apply-Orbit-File", False),
+        ]
+        if "_SLC__" in self.granule:
+            steps.append(Step("TOPSAR-Deburst", "TOPSAR-Deburst", [], "Calibration", False))
 
-    def _process_img_file(self, img_file):
-        print("\nCreating output file")
-        temp_file = "temp.tif"
-        system_call(["gdal_translate", "-of", "GTiff", "-a_nodata", "0", img_file, temp_file])
-        cleanup(img_file)
+        steps += [
+            Step("Speckle-Filter", "Speckle-Filter", ["-Pfilter=Lee Sigma"], steps[-1].target, False),
+            Step("Multilook", "Multilook", self._get_multilook_args(range_looks), "Speckle-Filter", False),
+            Step("Terrain-Flattening", "Terrain-Flattening", ["-PreGridMethod=False"], "Multilook", True),
+        ]
+
+        outputs = []
+        terrain_correction_args = ["-PpixelSpacingInMeter=30.0", f"-PmapProjection={self.projection}", f"-PimgResamplingMethod={self.image_resampling}", f"-PsaveProjectedLocalIncidenceAngle={self.has_incidence_angle}"]
+        # The combined pass works the mask out for each output pixel from the geometry it already computes,
+        # rather than resampling a mask simulated in radar geometry, so the mask is never interpolated
+        if self.has_layover and self.combined_terrain_correction:
+            terrain_correction_args.append("-PsaveLayoverShadowMask=true")
+        elif self.has_layover:
+            steps += [
+                Step("SAR-Simulation", "SAR-Simulation", ["-PsaveLayoverShadowMask=true"], "Terrain-Flattening", True),
+                Step("Terrain-Correction-Layover", "Terrain-Correction", [f"-PmapProjection={self.projection}", "-PimgResamplingMethod=NEAREST_NEIGHBOUR", "-PpixelSpacingInMeter=30.0", "-PsourceBands=layover_shadow_mask"], "SAR-Simulation", True),
+            ]
+            outputs.append("Terrain-Correction-Layover")
+
+        steps.append(Step("Terrain-Correction", "Terrain-Correction", terrain_correction_args, "Terrain-Flattening", True))
+        outputs.append("Terrain-Correction")
+        return steps, outputs
+
+    def _get_range_looks(self):
+        return self.range_looks or (12 if "_SLC__" in self.granule else 3)
 
+    # None when SNAP works the azimuth looks out for itself, which the NumPy engine does not do
+    def _get_azimuth_looks(self):
+        if self.azimuth_looks or self._uses_engine(Step("Multilook", "Multilook", [], None, False)):
+            return self.azimuth_looks or 3
+        return None
+
+    # Unless told the azimuth looks, SNAP works them out from the range looks to give square ground pixels
+    def _get_multilook_args(self, range_looks):
+        if self.azimuth_looks:
+            return [f"-PnRgLooks={range_looks}", f"-PnAzLooks={self.azimuth_looks}", "-PgrSquarePixel=false", "-PindependentLooks=true"]
+        return [f"-PnRgLooks={range_looks}", "-PnAzLooks=3"]
+
+    # What a step ran with, including everything upstream of it, so changing a step reruns all that follow it
+    def _get_step_parameters(self, steps):
+        parameters = {None: None}
+        for step in steps:
+            parameters[step.target] = {
+                "command": step.command,
+                "args": step.args,
+                "dem": self.dem_parameters if step.use_dem else None,
+                "engine": "numpy" if self._uses_engine(step) else "gpt",
+                "source": parameters[step.source],
+            }
+        return parameters
+
+    # Steps to run: those not completed with the same parameters, and completed ones whose product a step
+    # still to run or the output files need but which has already been removed
+    def _get_pending_steps(self, steps, outputs):
+        parameters = self._get_step_parameters(steps)
+        pending = set()
+        for step in reversed(steps):
+            product = self.manifest.get(step.target, parameters[step.target])
+            needed = step.target in outputs or any(later.source == step.target and later.target in pending for later in steps)
+            if product is None or (needed and not os.path.exists(product)):
+                pending.add(step.target)
+        return pending
+
+    # Run each step as its own gpt call, removing intermediate products once no later step reads them
+    def _run_steps(self, local_file, steps, outputs):
+        parameters = self._get_step_parameters(steps)
+        pending = self._get_pending_steps(steps, outputs)
+        last_use = {step.source: ii for ii, step in enumerate(steps) if step.target in pending}
+        products = {None: local_file}
+        for ii, step in enumerate(steps):
+            if step.target not in pending:
+                print(f"\nReusing {step.target} from an earlier run")
+                products[step.target] = self.manifest.get(step.target, parameters[step.target])
+                continue
+            target = self.scratch.get_target(step.target, self._estimate_size(step, get_product_size(products[step.source])))
+            products[step.target] = self._run_step(step, products[step.source], target, last_use[step.source] == ii)
+            self.manifest.complete(step.target, parameters[step.target], products[step.target])
+        return [products[output] for output in outputs]
+
+    # The NumPy engine reads BEAM-DIMAP products of detected images, so it only calibrates GRD granules.
+    # Speckle filtering and multilooking come after calibration to intensity, so they can run in the engine
+    # for SLC granules too
+    def _uses_engine(self, step):
+        if step.command == "Calibration" and "_SLC__" in self.granule:
+            return False
+        return step.command in self.engine_steps
+
+    def _run_step(self, step, source, target, cleanup_flag):
+        if not self._uses_engine(step):
+            dem_parameters = self.dem_parameters if step.use_dem else None
+            return gpt(source, step.command, *step.args, dem_parameters=dem_parameters, cleanup_flag=cleanup_flag, target=target)
+
+        print(f"\n{step.command} (NumPy engine)")
+        with profiling.stage(f"numpy {step.command}"):
+            product = engine.run_operator(step.command, source, target, get_graph_parameters(step.args), self.engine_jobs, self.tile_rows)
+        if cleanup_flag:
+            cleanup(source)
+        return product
+
+    @staticmethod
+    def _estimate_size(step, source_size):
+        if step.command == "Multilook":
+            parameters = get_graph_parameters(step.args)
+            return source_size / (int(parameters["nRgLooks"]) * int(parameters["nAzLooks"]))
+        return source_size * STEP_SIZE_FACTORS.get(step.command, 1)
+
+    # Run the whole chain as a single SNAP graph so intermediate products never touch the disk
+    def _run_graph(self, local_file, steps, outputs):
+        print("\nBuilding processing graph")
+        graph = Graph()
+        graph.add_node("Read", "Read", parameters={"file": local_file})
+        for step in steps:
+            parameters = get_graph_parameters(step.args)
+            if step.use_dem:
+                parameters.update(get_graph_parameters(self.dem_parameters))
+            graph.add_node(step.target, step.command, [step.source or "Read"], parameters)
+        dim_files = []
+        for output in outputs:
+            dim_files.append(self.scratch.get_target(f"{output}.dim", get_product_size(local_file)))
+            graph.add_node(f"Write-{output}", "Write", [output], {"file": dim_files[-1], "formatName": "BEAM-DIMAP"})
+
+        graph_file = graph.write("graph.xml")
+        system_call(["gpt", graph_file])
+        cleanup(graph_file)
+        cleanup(local_file)
+        self.manifest.complete("graph", self._get_graph_parameters(steps, outputs), dim_files)
+        return dim_files
+
+    # The graph runs as one stage, made up of all its steps
+    def _get_graph_parameters(self, steps, outputs):
+        parameters = self._get_step_parameters(steps)
+        return {"outputs": outputs, "steps": [parameters[output] for output in outputs]}
+
+    def _get_graph_products(self, steps, outputs):
+        dim_files = self.manifest.get("graph", self._get_graph_parameters(steps, outputs))
+        if dim_files and all(os.path.exists(dim_file) for dim_file in dim_files):
+            print("\nReusing the products of the processing graph from an earlier run")
+            return dim_files
+        return None
+
+    def _process_img_file(self, img_file):
+        clean = quantize = False
         if "projectedLocalIncidenceAngle" in img_file:
             tiff_suffix = "PIA"
-        elif "layover_shadow_mask" in img_file:
+        elif "layover_shadow_mask" in img_file or "layoverShadowMask" in img_file:
             tiff_suffix = "LS"
         else:
-            if self.clean:
-                temp_file = self._clean_pixels(temp_file)
+            clean = self.clean
+            quantize = self.output_options.output_type == "UInt16dB"
             polarization = img_file[-6:-4]
             tiff_suffix = f"{polarization}_RTC"
 
-        system_call(["gdaladdo", "-r", "average", temp_file, "2", "4", "8", "16"])
-        system_call(["gdal_translate", "-co", "TILED=YES", "-co", "COMPRESS=DEFLATE", "-co", "COPY_SRC_OVERVIEWS=YES", temp_file, f"{self.output_dir}/{self.granule}_{tiff_suffix}.tif"])
-        cleanup(temp_file)
-
-    # Process images
-    def _clean_pixels(self, temp_file):
-        cleaned_file = "cleaned.tif"
-        system_call(["gdal_calc.py", "-A", temp_file, f"--outfile={cleaned_file}", "--calc=A*(A>.005)", "--NoDataValue=0"])
-        cleanup(temp_file)
-        return cleaned_file
+        output_file = f"{self.output_dir}/{self.granule}_{tiff_suffix}.tif"
+        print(f"\nCreating output file {output_file}")
+        os.makedirs(self.scratch.disk_dir, exist_ok=True)
+        write_geotiff(img_file, output_file, self.output_options, clean, quantize, self.scratch.disk_dir)
 
     # XML
     def _create_arcgis_xml(self):
@@ -229,6 +1222,11 @@ class ProcessGranule():
                 "polarization": groups[1],
                 "input_granule": self.granule,
                 "dem_name": self.dem_name,
+                "decibels": self.output_options.output_type == "UInt16dB",
+                "scale": DB_SCALE,
+                "offset": DB_OFFSET,
+                "range_looks": self._get_range_looks(),
+                "azimuth_looks": self._get_azimuth_looks(),
             }
 
             template = self._get_xml_template()
@@ -239,7 +1237,7 @@ class ProcessGranule():
 
     @staticmethod
     def _get_xml_template():
-        with open("arcgis_template.xml", "r") as t:
+        with open(TEMPLATE_FILE, "r") as t:
             template_text = t.read()
         template = Template(template_text)
         return template
@@ -252,41 +1250,250 @@ class ProcessGranule():
         return pretty_printed
 
 
-if __name__ == "__main__":
+# Batch processing
+# The DEM is prepared before the download so the download can be skipped when a rerun does not need it
+BATCH_STAGES = ["dem", "download", "process", "finalize"]
+
+
+def read_granule_file(granule_file):
+    with open(granule_file, "r") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def run_in_directory(directory, function, *args):
+    os.chdir(directory)
+    return function(*args)
+
+
+def needs_input(args, dem_name, dem_file):
+    return ProcessGranule(args, dem_name, dem_file).needs_input()
+
+
+def run_snap(args, dem_name, dem_file, local_file):
+    return ProcessGranule(args, dem_name, dem_file).run_snap(local_file)
+
+
+def create_output_files(args, dem_name, dim_files):
+    ProcessGranule(args, dem_name).create_output_files(dim_files)
+
+
+# Granules flow through the stages as a pipeline: each stage has its own workers and a bounded queue in
+# front of it, so a download can run while the previous granule is in SNAP without piling up downloads
+class BatchProcessor():
+
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = os.getcwd()
+        self.jobs = {stage: getattr(args, f"{stage}_jobs") for stage in BATCH_STAGES}
+        self.queues = {stage: Queue(maxsize=jobs) for stage, jobs in self.jobs.items()}
+        self.errors = {}
+        self.cache = get_granule_cache(args)
+        self.dem_cache = get_dem_cache(args)
+        self.metadata_store = get_metadata_store(args)
+        self.network = get_network(args)
+
+    def process_granules(self, granules):
+        with ExitStack() as stack:
+            if self.network:
+                stack.enter_context(self.network)
+            return self._process_granules(granules)
+
+    def _process_granules(self, granules):
+        print(f"\nFetching granule information for {len(granules)} granules")
+        metadata = get_metadata_bulk(granules, self.metadata_store, self.network)
+        # Without the network event loop, each download runs in a worker process forked from this one
+        if not self.network:
+            get_earthdata_session()
+
+        workers = {}
+        for stage in BATCH_STAGES:
+            workers[stage] = [Thread(target=self._run_stage, args=(stage,)) for _ in range(self.jobs[stage])]
+            for worker in workers[stage]:
+                worker.start()
+
+        for granule in granules:
+            task = self._get_task(granule, metadata[granule])
+            if task:
+                self.queues[BATCH_STAGES[0]].put(task)
+
+        # Shut the pipeline down from the front once every granule has been queued
+        for stage in BATCH_STAGES:
+            for _ in workers[stage]:
+                self.queues[stage].put(None)
+            for worker in workers[stage]:
+                worker.join()
+
+        return {granule: self.errors.get(granule) for granule in granules}
+
+    def _run_stage(self, stage):
+        next_stage = BATCH_STAGES.index(stage) + 1
+        while True:
+            task = self.queues[stage].get()
+            if task is None:
+                return
+            try:
+                getattr(self, f"_{stage}")(task)
+            except SystemExit as e:
+                self.errors[task["granule"]] = f"{stage} exited with status {e.code}."
+            except Exception as e:
+                self.errors[task["granule"]] = f"{stage} failed: {type(e).__name__}: {e}"
+
+            if next_stage < len(BATCH_STAGES) and task["granule"] not in self.errors:
+                self.queues[BATCH_STAGES[next_stage]].put(task)
+
+    # Stages that write files run in a worker process of their own, inside the work directory of the granule.
+    # A worker that dies, say in a segfault in GDAL, then fails only its own granule, where in a shared pool
+    # it would break the pool for every task still to come
+    def _run_in_granule_dir(self, task, function, *args):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            return pool.submit(run_in_directory, task["granule_dir"], function, *args).result()
+
+    def _get_task(self, granule, metadata):
+        error = validate_metadata(granule, metadata)
+        if error:
+            self.errors[granule] = error
+            return None
+
+        task = {"granule": granule, "metadata": metadata, "granule_dir": os.path.join(self.work_dir, granule)}
+        os.makedirs(task["granule_dir"], exist_ok=True)
+        profiling.reset(task["granule_dir"])
+        task["args"] = copy(self.args)
+        task["args"].granule = granule
+        return task
+
+    def _download(self, task):
+        task["local_file"] = None
+        if not self._run_in_granule_dir(task, needs_input, task["args"], task["dem_name"], task["dem_file"]):
+            print(f"\nResuming processing of {task['granule']} from an earlier run")
+            return
+        # With the network event loop, downloads are requests in flight on it rather than worker processes
+        if self.network:
+            start = time()
+            coroutine = download_file_async(self.network, task["metadata"]["download_url"], task["granule_dir"], self.args.download_connections, self.cache)
+            local_file = self.network.run(coroutine)
+            # The event loop downloads every granule at once in this process, so only the time taken and the
+            # size of the granule belong to this one
+            profiling.record("download", time() - start, 0, 0, 0, os.path.getsize(local_file), task["granule_dir"])
+            task["local_file"] = os.path.basename(local_file)
+            return
+        task["local_file"] = self._run_in_granule_dir(task, download_file, task["metadata"]["download_url"], self.args.download_connections, self.cache)
+
+    def _dem(self, task):
+        task["dem_name"], task["dem_file"] = self._run_in_granule_dir(task, get_dem_source, self.args.demSource, task["metadata"]["bounding_box"], self.dem_cache)
+
+    def _process(self, task):
+        task["dim_files"] = self._run_in_granule_dir(task, run_snap, task["args"], task["dem_name"], task["dem_file"], task["local_file"])
+
+    def _finalize(self, task):
+        self._run_in_granule_dir(task, create_output_files, task["args"], task["dem_name"], task["dim_files"])
+        rmtree(task["granule_dir"])
+
+
+def get_argument_parser():
     parser = ArgumentParser(description="Radiometric Terrain Correction using the SENTINEL-1 Toolbox")
-    parser.add_argument("--granule", "-g", type=str, help="Sentinel-1 granule name. SLC and GRD granules are supported.", required=True)
+    parser.add_argument("--granule", "-g", type=str, dest="granules", action="append", default=[], help="Sentinel-1 granule name. SLC and GRD granules are supported. May be given more than once to process several granules.")
+    parser.add_argument("--granuleFile", "-f", type=str, dest="granule_file", help="File listing Sentinel-1 granule names to process, one per line.")
     parser.add_argument("--username", "-u", type=str, help="Earthdata Login username.")
     parser.add_argument("--password", "-p", type=str, help="Earthdata Login password.")
     parser.add_argument("--demSource", "-d", type=str, help="Source for digital elevation models: Geoid-corrected NED/SRTM sourced from ASF, or SRTM sourced from ESA. The default is %(default)s.", choices=["ASF", "ESA"], default="ASF")
     parser.add_argument("--layover", "-l", dest="has_layover", action="store_true", help="Include layover shadow mask in output.")
     parser.add_argument("--incidenceAngle", "-i", dest="has_incidence_angle", action="store_true", help="Include projected local incidence angle in output.")
     parser.add_argument("--clean", "-c", dest="clean", action="store_true", help="Set very small pixel values to No Data. Helpful to clean edge artifacts of granules processed before IPF version 2.90 (3/13/2018). May adversely affect valid data.")
+    parser.add_argument("--combinedTerrainCorrection", dest="combined_terrain_correction", action="store_true", help="With --layover, compute the layover shadow mask in the same Terrain-Correction pass as the backscatter instead of with separate SAR-Simulation and Terrain-Correction passes. Needs a SNAP release whose Terrain-Correction operator has the saveLayoverShadowMask parameter, which is checked before any processing starts.")
+    parser.add_argument("--imageResampling", type=str, dest="image_resampling", choices=["BILINEAR_INTERPOLATION", "CUBIC_CONVOLUTION", "BICUBIC_INTERPOLATION"], default="BILINEAR_INTERPOLATION", help="Resampling of the backscatter and incidence angle in Terrain-Correction. The layover shadow mask always uses nearest neighbour. The default is %(default)s.")
+    parser.add_argument("--graph", dest="use_graph", action="store_true", help="Run the whole processing chain as a single SNAP graph instead of one gpt call per operator. Faster, but needs enough memory to hold the chain.")
+    parser.add_argument("--calibration", type=str, choices=["gpt", "numpy"], default="gpt", help="Calibrate to beta0 with SNAP, or with the tiled NumPy engine for GRD granules. SLC granules are always calibrated with SNAP. The default is %(default)s.")
+    parser.add_argument("--speckleFilter", type=str, dest="speckle_filter", choices=["gpt", "numpy"], default="gpt", help="Run the Lee Sigma speckle filter with SNAP, or with the NumPy engine for any granule. At least 99% of the NumPy filter's pixels are within a relative 1e-3 of SNAP's, and those next to bright point targets may differ more. The default is %(default)s.")
+    parser.add_argument("--multilook", type=str, choices=["gpt", "numpy"], default="gpt", help="Run multilooking with SNAP, or with the NumPy engine for any granule. The default is %(default)s.")
+    parser.add_argument("--rangeLooks", type=int, dest="range_looks", help="Number of looks in range when multilooking. The default is 3 for GRD and 12 for SLC granules.")
+    parser.add_argument("--azimuthLooks", type=int, dest="azimuth_looks", help="Number of looks in azimuth when multilooking. By default SNAP works it out from --rangeLooks to give square ground pixels, and the NumPy engine takes 3.")
+    parser.add_argument("--engineJobs", type=int, dest="engine_jobs", default=os.cpu_count(), help="Number of processes the NumPy engine spreads the tiles of a band over. The default is the number of cores.")
+    parser.add_argument("--tileRows", type=int, dest="tile_rows", default=512, help="Number of image rows in each tile of the NumPy engine. The default is %(default)s.")
+    parser.add_argument("--outputDir", type=str, dest="output_dir", default="/output", help="Directory the output files are written to. The default is %(default)s.")
+    parser.add_argument("--scratchDir", type=str, dest="scratch_dir", help="Directory for intermediate products, and the uncompressed GeoTIFFs the output files are copied from, ideally on fast local disk. Processing that failed resumes from its last completed step when run again with the same scratch directory. The default is the working directory.")
+    parser.add_argument("--memoryScratchDir", type=str, dest="memory_scratch_dir", default="/dev/shm", help="RAM-backed directory for intermediate products that fit in --memoryScratchSize. The default is %(default)s.")
+    parser.add_argument("--memoryScratchSize", type=float, dest="memory_scratch_size", default=0, help="Space in GB that intermediate products may take up in --memoryScratchDir before going to --scratchDir. The default is %(default)s, which keeps them out of memory.")
+    parser.add_argument("--profile", action="store_true", help="Write a JSON report of the time, CPU, memory and disk use of each processing step next to the output files. The peak memory of external tools is sampled every 0.2 seconds while they run, and the bands converted to GeoTIFF at once are reported together as one step.")
+    parser.add_argument("--downloadConnections", type=int, dest="download_connections", default=1, help="Number of HTTP connections used to download each granule. The default is %(default)s.")
+    parser.add_argument("--cacheDir", type=str, dest="cache_dir", help="Directory for keeping granule information, downloaded granules and DEM tiles between runs. Nothing is cached by default.")
+    parser.add_argument("--cacheSize", type=float, dest="cache_size", default=100, help="Size limit of the granule cache in GB. The least recently used granules are removed beyond it. The default is %(default)s.")
+    parser.add_argument("--demCacheSize", type=float, dest="dem_cache_size", default=20, help="Size limit of the DEM tile and mosaic cache in GB, used with --cacheDir. The default is %(default)s.")
+    parser.add_argument("--metadataTtl", type=float, dest="metadata_ttl", default=24, help="Hours that granule information looked up from CMR is kept for, used with --cacheDir. The default is %(default)s.")
+    parser.add_argument("--asyncNetwork", dest="async_network", action="store_true", help="Search CMR and download granules on a single asyncio event loop, keeping many requests in flight without a thread or process for each.")
+    parser.add_argument("--connectionLimit", type=int, dest="connection_limit", default=100, help="Number of HTTP connections open at once with --asyncNetwork. The default is %(default)s.")
+    parser.add_argument("--hostConnectionLimit", type=int, dest="host_connection_limit", default=10, help="Number of HTTP connections open at once to any one host with --asyncNetwork. The default is %(default)s.")
+    parser.add_argument("--downloadJobs", type=int, dest="download_jobs", default=2, help="Number of granule downloads to run at once when processing several granules. The default is %(default)s.")
+    parser.add_argument("--demJobs", type=int, dest="dem_jobs", default=1, help="Number of digital elevation models to prepare at once when processing several granules. The default is %(default)s.")
+    parser.add_argument("--processJobs", type=int, dest="process_jobs", default=1, help="Number of granules to process with SNAP at once when processing several granules. Each one needs 16 GB of RAM. The default is %(default)s.")
+    parser.add_argument("--bandJobs", type=int, dest="band_jobs", default=4, help="Number of output bands of a granule to convert to GeoTIFF at once. The default is %(default)s.")
+    parser.add_argument("--gdalThreads", type=int, dest="gdal_threads", help="Number of threads GDAL uses to compress each output band and build its overviews. The default is the number of cores divided by --bandJobs.")
+    parser.add_argument("--gdalCacheMax", type=int, dest="gdal_cache_max", help="Size in MB of the GDAL block cache. The default is an eighth of the physical memory.")
+    parser.add_argument("--outputFormat", type=str, dest="output_format", choices=["GTiff", "COG"], default="GTiff", help="Write tiled GeoTIFFs with internal overviews ahead of the full resolution data, built in a temporary uncompressed copy of each band, or Cloud Optimized GeoTIFFs in a single pass with GDAL's COG driver, which needs GDAL 3.1 or later. The default is %(default)s.")
+    parser.add_argument("--outputType", type=str, dest="output_type", choices=["Float32", "UInt16dB"], default="Float32", help="Store backscatter as power, or in decibels as UInt16 values with the scale and offset that recover them kept in the GeoTIFF. Overviews of decibel output are resampled from power, as for Float32 output, before conversion. The default is %(default)s.")
+    parser.add_argument("--compression", type=str, choices=["DEFLATE", "ZSTD", "LERC"], default="DEFLATE", help="Compression of the output GeoTIFFs. The default is %(default)s.")
+    parser.add_argument("--maxZError", type=float, dest="max_z_error", default=0, help="Largest error LERC compression may introduce in the output values, 0 for lossless. The default is %(default)s.")
+    parser.add_argument("--blockSize", type=int, dest="block_size", default=256, help="Width and height in pixels of the tiles of the output GeoTIFFs. The default is %(default)s.")
+    parser.add_argument("--overviewResampling", type=str, dest="overview_resampling", choices=["AVERAGE", "NEAREST", "BILINEAR", "CUBIC", "CUBICSPLINE", "LANCZOS", "MODE"], default="AVERAGE", help="Resampling used to build the overviews of the output GeoTIFFs. The default is %(default)s.")
+    parser.add_argument("--predictor", type=int, choices=[1, 2, 3], default=3, help="Predictor of DEFLATE and ZSTD compressed output GeoTIFFs: 1 for none, 2 for horizontal differencing, 3 for floating point prediction. Bands that are not floating point use 2 instead of 3. The default is %(default)s.")
+    parser.add_argument("--zlevel", type=int, choices=range(1, 10), metavar="{1-9}", default=6, help="DEFLATE compression level of the output GeoTIFFs. The default is %(default)s.")
+    parser.add_argument("--finalizeJobs", type=int, dest="finalize_jobs", default=1, help="Number of granules to convert to GeoTIFF at once when processing several granules. The default is %(default)s.")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_argument_parser()
     args = parser.parse_args()
 
+    granules = args.granules
+    if args.granule_file:
+        granules += read_granule_file(args.granule_file)
+    if not granules:
+        parser.error("at least one granule is required, use --granule or --granuleFile")
+    if args.use_graph and "numpy" in (args.calibration, args.speckle_filter, args.multilook):
+        parser.error("--graph runs every step in SNAP and cannot be used with the NumPy engine")
+    # Otherwise the run would only fail at the last SNAP step
+    if args.combined_terrain_correction and args.has_layover and not has_gpt_parameter("Terrain-Correction", "saveLayoverShadowMask"):
+        parser.error("--combinedTerrainCorrection needs a SNAP release whose Terrain-Correction operator has the saveLayoverShadowMask parameter, which the installed one does not")
+
     if not args.username:
         args.username = input("\nEarthdata Login username: ")
 
     if not args.password:
         args.password = getpass("\nEarthdata Login password: ")
 
-    metadata = get_metadata(args.granule)
-    if metadata is None:
-        print(f"\nERROR: Either {args.granule} does exist or it is not a GRD/SLC product.")
-        exit(1)
+    profiling.enabled = args.profile
+    set_earthdata_credentials(args.username, args.password)
+    if len(granules) > 1:
+        errors = BatchProcessor(args).process_granules(granules)
+        print(f"\nProcessed {len(granules)} granules")
+        for granule, error in errors.items():
+            print(f"{granule}: {error or 'OK'}")
+        exit(1 if any(errors.values()) else 0)
 
-    if metadata["bounding_box"]["lon_min"] < -170 and metadata["bounding_box"]["lon_max"] > 170:
-        print(f"\nERROR: Granules crossing the antimeridian are not supported.")
-        exit(1)
+    args.granule = granules[0]
+    profiling.reset()
+    with ExitStack() as stack:
+        network = get_network(args)
+        if network:
+            stack.enter_context(network)
+        metadata = get_metadata(args.granule, get_metadata_store(args), network)
+        error = validate_metadata(args.granule, metadata)
+        if error:
+            print(f"\nERROR: {error}")
+            exit(1)
 
-    write_netrc_file(args.username, args.password)
-    local_file = download_file(metadata["download_url"])
-
-    if args.demSource == "ASF":
-        dem_name = get_dem_file(metadata["bounding_box"])
-        dem_file = dem_name
-    else:
-        dem_name = 'SRTM 1Sec Hgt'
-        dem_file = None
+        # The DEM comes first since the processing steps a rerun can skip, and so whether it needs the granule,
+        # depend on it
+        dem_name, dem_file = get_dem_source(args.demSource, metadata["bounding_box"], get_dem_cache(args))
+        pg = ProcessGranule(args, dem_name, dem_file)
+        local_file = None
+        if not pg.needs_input():
+            print("\nResuming processing from an earlier run")
+        elif network:
+            with profiling.stage("download"):
+                local_file = network.run(download_file_async(network, metadata["download_url"], ".", args.download_connections, get_granule_cache(args)))
+        else:
+            local_file = download_file(metadata["download_url"], args.download_connections, get_granule_cache(args))
 
-    pg = ProcessGranule(args, dem_name, dem_file)
     pg.process_granule(local_file)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# Offline benchmark of the RTC pipeline. CMR, the granule download server, hyp3-lib's get_dem, gpt and GDAL
+# are replaced by local stand-ins with tunable cost, so changes to orchestration and scheduling can be measured
+# without network access or Earthdata credentials:
+#
+#     python3 tests/benchmark/benchmark.py --granules 8 --granuleSize 256 --report benchmark.json
+#
+# The cost of the fake tools is set with RTC_BENCH_GPT_SECONDS, RTC_BENCH_GDAL_SECONDS and
+# RTC_BENCH_RASTER_SIZE, see fake_tool.py. When the GDAL Python bindings are installed they are used for real.
+# calibration.py, speckle_filter.py and multilook.py compare the NumPy engine with the real gpt instead.
+
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import types
+import urllib.parse
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from shutil import copyfile, rmtree
+from threading import Thread
+from time import process_time, sleep, time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARK_DIR, "..", "..", "src")
+FAKE_TOOLS = ["gpt"]
+POLYGON = "64.0 -147.0 64.0 -145.0 65.0 -145.0 65.0 -147.0 64.0 -147.0"
+PATTERN = os.urandom(1 << 20)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # Worker processes drop their kept-alive connections when they exit
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def get_granule_names(count):
+    return [f"S1A_IW_GRDH_1SDV_20190101T000000_20190101T000025_000000_000000_{ii:04X}" for ii in range(count)]
+
+
+# Stand-in CMR and Earthdata Login: every granule name asked for exists and points at the local file server
+class CmrHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path.endswith("/find_or_create_token"):
+            self.server.logins += 1
+            self.send_json({"access_token": "benchmark"})
+            return
+
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        page_size = int(form["page_size"][0])
+        start = int(self.headers.get("CMR-Search-After", "0"))
+        names = form.get("readable_granule_name", [])[start:start + page_size]
+        entries = [{
+            "producer_granule_id": name,
+            "title": f"{name}-GRD_HD",
+            "granule_size": str(self.server.granule_size / 2 ** 20),
+            "polygons": [[POLYGON]],
+            "links": [{"rel": "http://esipfed.org/ns/fedsearch/1.1/data#", "href": f"{self.server.file_url}/{name}.zip"}],
+        } for name in names]
+        self.send_json({"feed": {"entry": entries}}, {"CMR-Search-After": str(start + page_size)})
+
+    def send_json(self, content, headers=None):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Stand-in download server: serves synthetic granule zips of a fixed size, with range and ETag support, or
+# redirects every request to another server like the data hosts do to their storage, with a new signature
+# each time. It keeps the Authorization headers it was sent. With max_uses it refuses a signed URL after that
+# many requests, like presigned URLs that expire
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.authorizations.append(self.headers.get("Authorization"))
+        if self.server.redirect_url:
+            self.server.signatures += 1
+            self.send_response(302)
+            self.send_header("Location", f"{self.server.redirect_url}{self.path}?signature={self.server.signatures}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.server.max_uses:
+            self.server.uses[self.path] = self.server.uses.get(self.path, 0) + 1
+            if self.server.uses[self.path] > self.server.max_uses:
+                self.send_response(403)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        size = self.server.granule_size
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        self.send_response(206 if match else 200)
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", f'"{os.path.basename(urllib.parse.urlparse(self.path).path)}-{size}"')
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        offset = start
+        while offset <= end:
+            chunk_start = offset % len(PATTERN)
+            chunk = PATTERN[chunk_start:chunk_start + end - offset + 1]
+            self.wfile.write(chunk)
+            offset += len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler, granule_size, file_url=None, redirect_url=None, max_uses=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.granule_size = granule_size
+    server.file_url = file_url
+    server.redirect_url = redirect_url
+    server.max_uses = max_uses
+    server.uses = {}
+    server.signatures = 0
+    server.authorizations = []
+    server.logins = 0
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def has_gdal():
+    return hasattr(sys.modules["osgeo"].gdal, "Open")
+
+
+# Stand-in for hyp3-lib's get_dem module, leaving behind the same temporary files. Like hyp3-lib, it writes
+# a Float32 DEM when GDAL is installed, which rtc hands to SNAP as Int16
+def fake_get_dem(x_min, y_min, x_max, y_max, outfile, *args, **kwargs):
+    sleep(float(os.environ.get("RTC_BENCH_DEM_SECONDS", "0.5")))
+    os.makedirs("DEM", exist_ok=True)
+    for file_name in ["temp.vrt", "tempdem.tif", "temputm.tif", outfile]:
+        with open(file_name, "wb") as f:
+            f.write(PATTERN)
+    if has_gdal():
+        gdal = sys.modules["osgeo"].gdal
+        dataset = gdal.GetDriverByName("GTiff").Create(outfile, 256, 256, 1, gdal.GDT_Float32)
+        dataset.SetGeoTransform([x_min, (x_max - x_min) / 256, 0, y_max, 0, (y_min - y_max) / 256])
+        dataset.GetRasterBand(1).Fill(123.4)
+        dataset = None
+    return "SRTMGL1"
+
+
+# Stand-ins for GDAL when the Python bindings are not installed
+def fake_create_int16_vrt(raster_file, vrt_file):
+    with open(vrt_file, "w") as f:
+        f.write(f"<VRTDataset><SourceFilename>{raster_file}</SourceFilename></VRTDataset>")
+
+
+def fake_write_geotiff(input_file, output_file, *args):
+    end = process_time() + float(os.environ.get("RTC_BENCH_GDAL_SECONDS", "0.1"))
+    while process_time() < end:
+        pass
+    copyfile(input_file, output_file)
+
+
+def install_fakes(bin_dir):
+    for tool in FAKE_TOOLS:
+        os.symlink(os.path.join(BENCHMARK_DIR, "fake_tool.py"), os.path.join(bin_dir, tool))
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+    get_dem = types.ModuleType("get_dem")
+    get_dem.get_dem = fake_get_dem
+    get_dem.get_tile_for = lambda args: None
+    sys.modules["get_dem"] = get_dem
+
+    try:
+        import osgeo.gdal  # noqa: F401
+    except ImportError:
+        osgeo = types.ModuleType("osgeo")
+        osgeo.gdal = types.SimpleNamespace(GDT_Int16=3, SetCacheMax=lambda size: None, SetConfigOption=lambda key, value: None)
+        sys.modules["osgeo"] = osgeo
+
+
+async def gather(coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+def timed(function, *args):
+    start = time()
+    result = function(*args)
+    return time() - start, result
+
+
+class Benchmark():
+
+    def __init__(self, options, rtc):
+        self.options = options
+        self.rtc = rtc
+        self.granule_size = options.granule_size * 2 ** 20
+        self.granules = get_granule_names(options.granules)
+        self.work_dir = tempfile.mkdtemp(prefix="rtc-benchmark-")
+        self.output_dir = os.path.join(self.work_dir, "output")
+        os.makedirs(self.output_dir)
+
+        self.file_server, file_url = start_server(FileHandler, self.granule_size)
+        self.cmr_server, cmr_url = start_server(CmrHandler, self.granule_size, file_url)
+        rtc.CMR_URL = cmr_url
+        rtc.EARTHDATA_TOKEN_URL = f"{cmr_url}/api/users/find_or_create_token"
+        rtc.TOKEN_HOSTS = {"127.0.0.1"}
+        rtc.set_earthdata_credentials("benchmark", "benchmark")
+        if not has_gdal():
+            rtc.create_int16_vrt = fake_create_int16_vrt
+            rtc.write_geotiff = fake_write_geotiff
+
+    def get_args(self, *extra_args):
+        args = self.rtc.get_argument_parser().parse_args(["--outputDir", self.output_dir] + list(extra_args))
+        args.granule = self.granules[0]
+        return args
+
+    def get_network(self):
+        return self.rtc.AsyncNetwork(user_agent=self.rtc.USER_AGENT)
+
+    def in_directory(self, name):
+        directory = os.path.join(self.work_dir, name)
+        os.makedirs(directory, exist_ok=True)
+        os.chdir(directory)
+        return directory
+
+    def run(self):
+        report = {"options": vars(self.options)}
+        try:
+            report["metadata"] = self.benchmark_metadata()
+            report["download"] = self.benchmark_download()
+            report["token_scope"] = self.check_token_scope()
+            report["url_refresh"] = self.check_url_refresh()
+            report["gpt_parameters"] = self.check_gpt_parameters()
+            report["dem"] = self.benchmark_dem()
+            report["process"] = self.benchmark_process()
+            report["batch"] = self.benchmark_batch()
+        finally:
+            os.chdir(BENCHMARK_DIR)
+            rmtree(self.work_dir)
+            self.file_server.shutdown()
+            self.cmr_server.shutdown()
+        return report
+
+    def benchmark_metadata(self):
+        single_time, _ = timed(lambda: [self.rtc.get_metadata(granule) for granule in self.granules])
+        bulk_time, _ = timed(self.rtc.get_metadata_bulk, self.granules)
+        with self.get_network() as network:
+            async_time, _ = timed(self.rtc.get_metadata_bulk, self.granules, None, network)
+        return {
+            "single_granules_per_second": len(self.granules) / single_time,
+            "bulk_granules_per_second": len(self.granules) / bulk_time,
+            "async_granules_per_second": len(self.granules) / async_time,
+        }
+
+    def benchmark_download(self):
+        results = {}
+        url = f"{self.cmr_server.file_url}/{self.granules[0]}.zip"
+        for connections in sorted({1, self.options.connections}):
+            self.in_directory(f"download-{connections}")
+            seconds, local_file = timed(self.rtc.download_file, url, connections)
+            os.unlink(local_file)
+            results[f"{connections}_connections_mb_per_second"] = self.granule_size / 2 ** 20 / seconds
+
+        # Every granule at once over the event loop
+        directory = self.in_directory("download-async")
+        urls = [f"{self.cmr_server.file_url}/{granule}.zip" for granule in self.granules]
+        with self.get_network() as network:
+            coroutines = [self.rtc.download_file_async(network, url, directory, self.options.connections) for url in urls]
+            seconds, local_files = timed(network.run, gather(coroutines))
+        for local_file in local_files:
+            os.unlink(local_file)
+        results["async_mb_per_second"] = len(urls) * self.granule_size / 2 ** 20 / seconds
+        return results
+
+    # The data host redirects to storage under another host name, which must never get the bearer token,
+    # neither on the redirect nor on the range requests that go to it directly
+    def check_token_scope(self):
+        self.in_directory("token")
+        storage_port = self.file_server.server_address[1]
+        data_server, data_url = start_server(FileHandler, self.granule_size, redirect_url=f"http://localhost:{storage_port}")
+        self.file_server.authorizations.clear()
+        try:
+            os.unlink(self.rtc.download_file(f"{data_url}/{self.granules[0]}.zip", self.options.connections))
+        finally:
+            data_server.shutdown()
+        if not any(data_server.authorizations):
+            raise RuntimeError("The data host was not sent the Earthdata bearer token")
+        if any(self.file_server.authorizations):
+            raise RuntimeError("The Earthdata bearer token was sent to the host downloads are redirected to")
+        return {"data_host_requests": len(data_server.authorizations), "storage_requests": len(self.file_server.authorizations)}
+
+    # Storage URLs that expire part way through a ranged download are replaced by asking the data host again,
+    # here once every range has started on the first URL and some have been refused
+    def check_url_refresh(self):
+        results = {}
+        storage_server, storage_url = start_server(FileHandler, self.granule_size, max_uses=self.options.connections // 2 + 2)
+        data_server, data_url = start_server(FileHandler, self.granule_size, redirect_url=storage_url)
+        try:
+            for mode, network in [("sync", None), ("async", self.get_network())]:
+                self.in_directory(f"url-refresh-{mode}")
+                url = f"{data_url}/{self.granules[0]}-{mode}.zip"
+                if network:
+                    with network:
+                        local_file = network.run(self.rtc.download_file_async(network, url, ".", self.options.connections))
+                else:
+                    local_file = self.rtc.download_file(url, self.options.connections)
+                if os.path.getsize(local_file) != self.granule_size:
+                    raise RuntimeError(f"The {mode} download is {os.path.getsize(local_file)} bytes rather than {self.granule_size}")
+                os.unlink(local_file)
+                results[f"{mode}_urls"] = data_server.signatures - sum(results.values())
+        finally:
+            data_server.shutdown()
+            storage_server.shutdown()
+        return results
+
+    def check_gpt_parameters(self):
+        if not self.rtc.has_gpt_parameter("Terrain-Correction", "saveLayoverShadowMask"):
+            raise RuntimeError("gpt's help for Terrain-Correction was not read")
+        if self.rtc.has_gpt_parameter("Terrain-Correction", "saveLayoverMask"):
+            raise RuntimeError("A parameter gpt does not list was taken to exist")
+        return {"saveLayoverShadowMask": True}
+
+    def benchmark_dem(self):
+        self.in_directory("dem")
+        metadata = self.rtc.get_metadata(self.granules[0])
+        seconds, (dem_name, dem_file) = timed(self.rtc.get_dem_file, metadata["bounding_box"])
+        if has_gdal() and self.rtc.gdal.Open(dem_file).GetRasterBand(1).DataType != self.rtc.gdal.GDT_Int16:
+            raise RuntimeError(f"{dem_file} does not read as Int16")
+        if os.path.exists("temp_dem"):
+            raise RuntimeError("The DEM mosaic was written twice")
+        for dem_file in self.rtc.get_dem_files(dem_name):
+            os.unlink(dem_file)
+        return {"seconds": seconds}
+
+    def benchmark_process(self):
+        results = {}
+        self.rtc.profiling.enabled = True
+        for mode, extra_args in [("steps", []), ("graph", ["--graph"]), ("combined", ["--combinedTerrainCorrection"]), ("engine", ["--calibration", "numpy", "--speckleFilter", "numpy", "--multilook", "numpy"])]:
+            self.in_directory(f"process-{mode}")
+            args = self.get_args("--layover", "--incidenceAngle", "--clean", *extra_args)
+            local_file = f"{args.granule}.zip"
+            with open(local_file, "wb") as f:
+                f.write(PATTERN)
+            seconds, _ = timed(self.rtc.ProcessGranule(args, "SRTM 1Sec Hgt").process_granule, local_file)
+
+            profile_file = os.path.join(self.output_dir, f"{args.granule}_profile.json")
+            with open(profile_file, "r") as f:
+                stages = json.load(f)["totals"]
+            for output_file in os.listdir(self.output_dir):
+                os.unlink(os.path.join(self.output_dir, output_file))
+            results[mode] = {"seconds": seconds, "stages": stages}
+        self.rtc.profiling.enabled = False
+        return results
+
+    def benchmark_batch(self):
+        self.in_directory("batch")
+        args = self.get_args(
+            "--downloadConnections", str(self.options.connections),
+            "--downloadJobs", str(self.options.download_jobs),
+            "--processJobs", str(self.options.process_jobs),
+            "--finalizeJobs", str(self.options.finalize_jobs),
+        )
+        # A session that has not logged in yet, as at the start of a run
+        self.rtc.set_earthdata_credentials("benchmark", "benchmark")
+        logins = self.cmr_server.logins
+        seconds, errors = timed(self.rtc.BatchProcessor(args).process_granules, self.granules)
+        if self.cmr_server.logins - logins != 1:
+            raise RuntimeError(f"The batch logged in to Earthdata {self.cmr_server.logins - logins} times rather than once")
+        return {
+            "seconds": seconds,
+            "granules_per_second": len(self.granules) / seconds,
+            "errors": {granule: error for granule, error in errors.items() if error},
+        }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Offline benchmark of the RTC pipeline with synthetic inputs")
+    parser.add_argument("--granules", type=int, default=4, help="Number of synthetic granules. The default is %(default)s.")
+    parser.add_argument("--granuleSize", type=int, dest="granule_size", default=64, help="Size of each synthetic granule zip in MB. The default is %(default)s.")
+    parser.add_argument("--connections", type=int, default=4, help="Download connections to compare with a single one. The default is %(default)s.")
+    parser.add_argument("--downloadJobs", type=int, dest="download_jobs", default=2, help="The default is %(default)s.")
+    parser.add_argument("--processJobs", type=int, dest="process_jobs", default=1, help="The default is %(default)s.")
+    parser.add_argument("--finalizeJobs", type=int, dest="finalize_jobs", default=1, help="The default is %(default)s.")
+    parser.add_argument("--report", type=str, help="Write the results to this JSON file as well as printing them.")
+    options = parser.parse_args()
+
+    # Worker processes of the batch processor have to inherit the stand-ins installed here
+    multiprocessing.set_start_method("fork")
+    bin_dir = tempfile.mkdtemp(prefix="rtc-benchmark-bin-")
+    install_fakes(bin_dir)
+    sys.path.insert(0, SRC_DIR)
+    import rtc
+
+    try:
+        report = Benchmark(options, rtc).run()
+    finally:
+        rmtree(bin_dir)
+
+    print(json.dumps(report, indent=2))
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# Benchmark of calibration to beta0 with gpt against the NumPy engine, on a real BEAM-DIMAP product of a GRD
+# granule such as the output of the Apply-Orbit-File step, left behind in the scratch directory by a failed run:
+#
+#     python3 tests/benchmark/calibration.py Apply-Orbit-File.dim --report calibration.json
+#
+# Both interpolate the same calibration vectors, so the check passes when at least --fraction of the pixels
+# where both have data are within a relative --tolerance.
+
+import subprocess
+
+from multilook import engine, get_argument_parser, run_comparison
+
+
+def run_gpt(options, target):
+    subprocess.run(["gpt", "Calibration", f"-Ssource={options.source}", "-t", target, "-PoutputBetaBand=true", "-PoutputSigmaBand=false"], check=True)
+
+
+def run_engine(options, target):
+    engine.run_operator("Calibration", options.source, target, {"outputBetaBand": "true", "outputSigmaBand": "false"}, options.jobs, options.tile_rows)
+
+
+if __name__ == "__main__":
+    parser = get_argument_parser("Compare calibration to beta0 with gpt and with the NumPy engine", "BEAM-DIMAP product of a GRD granule with orbit files applied.", tolerance=1e-4, fraction=0.999)
+    run_comparison(parser.parse_args(), "calibration", run_gpt, run_engine)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Stand-in for gpt, installed under its name by benchmark.py.
+# Each call burns a configurable amount of CPU and writes outputs shaped like the real ones.
+
+import os
+import sys
+from time import process_time
+
+import numpy as np
+from lxml import etree
+
+GPT_SECONDS = float(os.environ.get("RTC_BENCH_GPT_SECONDS", "0.5"))
+RASTER_SIZE = int(os.environ.get("RTC_BENCH_RASTER_SIZE", "1024"))
+# Parameters listed by gpt <operator> -h, for the ones rtc.py checks for
+HELP_PARAMETERS = {"Terrain-Correction": ["saveLayoverShadowMask=<boolean>", "saveProjectedLocalIncidenceAngle=<boolean>"]}
+
+ENVI_HEADER = """ENVI
+samples = {size}
+lines = {size}
+bands = 1
+header offset = 0
+file type = ENVI Standard
+data type = 4
+interleave = bsq
+byte order = 0
+"""
+CALIBRATION_LINE_STEP = 64
+CALIBRATION_PIXEL_STEP = 40
+
+
+def burn(seconds):
+    end = process_time() + seconds
+    while process_time() < end:
+        pass
+
+
+def get_bands(operator, parameters):
+    if operator != "Terrain-Correction":
+        return ["Beta0_VH", "Beta0_VV"]
+    if parameters.get("sourceBands") == "layover_shadow_mask":
+        return ["layover_shadow_mask"]
+    bands = ["Gamma0_VH", "Gamma0_VV"]
+    if parameters.get("saveProjectedLocalIncidenceAngle") == "True":
+        bands.append("projectedLocalIncidenceAngle")
+    if parameters.get("saveLayoverShadowMask") == "true":
+        bands.append("layover_shadow_mask")
+    return bands
+
+
+def write_product(dim_file, bands):
+    with open(dim_file, "w") as f:
+        f.write("<Dimap_Document/>\n")
+    data_dir = dim_file.replace(".dim", ".data")
+    os.makedirs(data_dir, exist_ok=True)
+    row = bytes(4 * RASTER_SIZE)
+    for band in bands:
+        with open(os.path.join(data_dir, f"{band}.img"), "wb") as f:
+            for _ in range(RASTER_SIZE):
+                f.write(row)
+        with open(os.path.join(data_dir, f"{band}.hdr"), "w") as f:
+            f.write(ENVI_HEADER.format(size=RASTER_SIZE))
+
+
+def add_element(parent, tag, text=None, **attributes):
+    element = etree.SubElement(parent, tag, **attributes)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def add_metadata(parent, name, attributes=None):
+    element = add_element(parent, "MDElem", name=name)
+    for key, value in (attributes or {}).items():
+        add_element(element, "MDATTR", value, name=key, type="ascii")
+    return element
+
+
+# Calibration vectors every CALIBRATION_LINE_STEP lines, with beta nought varying a little across the swath
+def add_calibration(parent, polarization):
+    calibration = add_metadata(add_metadata(parent, f"calibration-s1a-iw-grd-{polarization.lower()}.xml"), "calibration")
+    add_metadata(calibration, "adsHeader", {"polarisation": polarization})
+    vector_list = add_metadata(calibration, "calibrationVectorList")
+    pixels = list(range(0, RASTER_SIZE, CALIBRATION_PIXEL_STEP)) + [RASTER_SIZE - 1]
+    for line in list(range(0, RASTER_SIZE, CALIBRATION_LINE_STEP)) + [RASTER_SIZE - 1]:
+        vector = add_metadata(vector_list, "calibrationVector", {"line": line})
+        add_metadata(vector, "pixel", {"pixel": " ".join(str(pixel) for pixel in pixels)})
+        add_metadata(vector, "betaNought", {"betaNought": " ".join(f"{237 + pixel / RASTER_SIZE:.6f}" for pixel in pixels)})
+
+
+# An orbit corrected GRD product as SNAP writes it, with enough metadata for the NumPy engine to work from
+def write_grd_product(dim_file, polarizations):
+    data_dir = dim_file.replace(".dim", ".data")
+    os.makedirs(os.path.join(data_dir, "tie_point_grids"), exist_ok=True)
+    root = etree.Element("Dimap_Document", name=os.path.basename(dim_file))
+    dimensions = add_element(root, "Raster_Dimensions")
+    add_element(dimensions, "NCOLS", RASTER_SIZE)
+    add_element(dimensions, "NROWS", RASTER_SIZE)
+    add_element(dimensions, "NBANDS", len(polarizations))
+    data_access = add_element(root, "Data_Access")
+    add_element(data_access, "DATA_FILE_FORMAT", "ENVI")
+    grids = add_element(root, "Tie_Point_Grids")
+    interpretation = add_element(root, "Image_Interpretation")
+
+    random = np.random.RandomState(0)
+    for index, polarization in enumerate(polarizations):
+        name = f"Amplitude_{polarization}"
+        data_file = add_element(data_access, "Data_File")
+        add_element(data_file, "DATA_FILE_PATH", href=f"{os.path.basename(data_dir)}/{name}.hdr")
+        add_element(data_file, "BAND_INDEX", index)
+        band_info = add_element(interpretation, "Spectral_Band_Info")
+        for tag, value in [("BAND_INDEX", index), ("BAND_NAME", name), ("BAND_RASTER_WIDTH", RASTER_SIZE), ("BAND_RASTER_HEIGHT", RASTER_SIZE), ("DATA_TYPE", "uint16"), ("PHYSICAL_UNIT", "amplitude"), ("NO_DATA_VALUE_USED", "true"), ("NO_DATA_VALUE", 0.0)]:
+            add_element(band_info, tag, value)
+        # Single look speckle over a gently varying scene
+        scene = 100 + 50 * np.sin(np.arange(RASTER_SIZE) / 50.0)[None, :]
+        amplitude = np.sqrt(random.exponential(scene ** 2, (RASTER_SIZE, RASTER_SIZE)))
+        amplitude.clip(1, 65535).astype(">u2").tofile(os.path.join(data_dir, f"{name}.img"))
+        with open(os.path.join(data_dir, f"{name}.hdr"), "w") as f:
+            f.write(ENVI_HEADER.format(size=RASTER_SIZE).replace("data type = 4", "data type = 12").replace("byte order = 0", "byte order = 1"))
+
+    for name in ["latitude", "longitude", "incident_angle"]:
+        grid_file = add_element(data_access, "Tie_Point_Grid_File")
+        add_element(grid_file, "TIE_POINT_GRID_FILE_PATH", href=f"{os.path.basename(data_dir)}/tie_point_grids/{name}.hdr")
+        grid = add_element(grids, "Tie_Point_Grid_Info")
+        for tag, value in [("TIE_POINT_GRID_NAME", name), ("NCOLS", 21), ("NROWS", 10), ("OFFSET_X", 0.5), ("OFFSET_Y", 0.5), ("STEP_X", RASTER_SIZE / 20), ("STEP_Y", RASTER_SIZE / 9)]:
+            add_element(grid, tag, value)
+        np.zeros((10, 21), dtype=">f4").tofile(os.path.join(data_dir, "tie_point_grids", f"{name}.img"))
+
+    metadata = add_metadata(add_element(root, "Dataset_Sources"), "metadata")
+    add_metadata(metadata, "Abstracted_Metadata", {
+        "num_output_lines": RASTER_SIZE, "num_samples_per_line": RASTER_SIZE, "first_line_time": "30-APR-2019 16:15:29.000000",
+        "line_time_interval": 0.002055556, "range_spacing": 10.0, "azimuth_spacing": 10.0, "range_looks": 1.0, "azimuth_looks": 1.0,
+        "multilook_flag": 0, "abs_calibration_flag": 0,
+    })
+    calibration = add_metadata(add_metadata(metadata, "Original_Product_Metadata"), "calibration")
+    for polarization in polarizations:
+        add_calibration(calibration, polarization)
+    etree.ElementTree(root).write(dim_file, xml_declaration=True, encoding="ISO-8859-1", pretty_print=True)
+
+
+def get_parameters(args):
+    return dict(arg[len("-P"):].split("=", 1) for arg in args if arg.startswith("-P"))
+
+
+def gpt(args):
+    if "-h" in args:
+        print(f"Usage:\n  gpt {args[0]} [options]\n\nParameter Options:")
+        for parameter in HELP_PARAMETERS.get(args[0], []):
+            print(f"  -P{parameter}")
+        return
+    if args[0].endswith(".xml"):
+        nodes = {node.get("id"): node for node in etree.parse(args[0]).getroot().iter("node")}
+        writes = [node for node in nodes.values() if node.findtext("operator") == "Write"]
+        burn(GPT_SECONDS * (len(nodes) - len(writes) - 1))
+        for write in writes:
+            source = nodes[write.find("sources/sourceProduct").get("refid")]
+            parameters = {parameter.tag: parameter.text for parameter in source.find("parameters")}
+            write_product(write.findtext("parameters/file"), get_bands(source.findtext("operator"), parameters))
+        return
+
+    burn(GPT_SECONDS)
+    target = args[args.index("-t") + 1]
+    if args[0] == "Apply-Orbit-File":
+        write_grd_product(f"{target}.dim", ["VH", "VV"])
+        return
+    write_product(f"{target}.dim", get_bands(args[0], get_parameters(args)))
+
+
+if __name__ == "__main__":
+    tool = os.path.basename(sys.argv[0])
+    if tool == "gpt":
+        gpt(sys.argv[1:])
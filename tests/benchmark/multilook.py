@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Benchmark of multilooking with gpt against the NumPy engine, on a real BEAM-DIMAP product such as the output of
+# the Speckle-Filter step, left behind in the scratch directory by a failed run:
+#
+#     python3 tests/benchmark/multilook.py Speckle-Filter.dim --rangeLooks 3 --azimuthLooks 3 --report multilook.json
+#
+# Both write their products to a temporary directory next to the input, so the timings include the same disk.
+# The bands of the two products are compared where both have data. calibration.py and speckle_filter.py run
+# their operators through the same comparison.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from shutil import rmtree
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+import engine  # noqa: E402
+
+
+def timed(function, *args):
+    start = time()
+    function(*args)
+    return time() - start
+
+
+def run_gpt(options, target):
+    subprocess.run(["gpt", "Multilook", f"-Ssource={options.source}", "-t", target, f"-PnRgLooks={options.range_looks}", f"-PnAzLooks={options.azimuth_looks}", "-PgrSquarePixel=false", "-PindependentLooks=true"], check=True)
+
+
+def run_engine(options, target):
+    engine.run_operator("Multilook", options.source, target, {"nRgLooks": options.range_looks, "nAzLooks": options.azimuth_looks}, options.jobs, options.tile_rows)
+
+
+# With a tolerance, also the fraction of the pixels where both have data that are within it
+def compare(gpt_dim, engine_dim, tolerance=None):
+    gpt_bands = engine.Product(gpt_dim).get_bands()
+    results = {}
+    for name, img_file in engine.Product(engine_dim).get_bands().items():
+        expected, actual = engine.open_band(gpt_bands[name]), engine.open_band(img_file)
+        if expected.shape != actual.shape:
+            results[name] = {"shape": list(actual.shape), "gpt_shape": list(expected.shape)}
+            continue
+        valid = (expected != 0) & (actual != 0)
+        difference = np.abs(actual[valid].astype(np.float64) - expected[valid]) / np.abs(expected[valid])
+        results[name] = {
+            "shape": list(actual.shape),
+            "max_relative_difference": float(difference.max()) if difference.size else 0.0,
+            "mean_relative_difference": float(difference.mean()) if difference.size else 0.0,
+            "no_data_mismatches": int(((expected == 0) != (actual == 0)).sum()),
+        }
+        if tolerance is not None:
+            results[name]["within_tolerance"] = float((difference <= tolerance).mean()) if difference.size else 1.0
+    return results
+
+
+# The options every comparison takes. With a default tolerance, the comparison also checks that at least
+# --fraction of the pixels are within --tolerance of gpt
+def get_argument_parser(description, source_help, tolerance=None, fraction=None):
+    parser = ArgumentParser(description=description)
+    parser.add_argument("source", type=str, help=source_help)
+    if tolerance is not None:
+        parser.add_argument("--tolerance", type=float, default=tolerance, help="Relative difference from gpt a pixel may have. The default is %(default)s.")
+        parser.add_argument("--fraction", type=float, default=fraction, help="Fraction of the pixels that must be within --tolerance. The default is %(default)s.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Processes of the NumPy engine. The default is %(default)s.")
+    parser.add_argument("--tileRows", type=int, dest="tile_rows", default=512, help="The default is %(default)s.")
+    parser.add_argument("--report", type=str, help="Write the results to this JSON file as well as printing them.")
+    return parser
+
+
+# Runs gpt and the engine on the source, each called with the options and the target to write, and reports
+# the timings and differences. Exits with an error when a tolerance was set and a band is not within it
+def run_comparison(options, name, run_gpt, run_engine):
+    tolerance = getattr(options, "tolerance", None)
+    work_dir = tempfile.mkdtemp(prefix=f"rtc-{name}-", dir=os.path.dirname(os.path.abspath(options.source)))
+    try:
+        gpt_target, engine_target = os.path.join(work_dir, "gpt"), os.path.join(work_dir, "engine")
+        report = {
+            "options": vars(options),
+            "gpt_seconds": timed(run_gpt, options, gpt_target),
+            "engine_seconds": timed(run_engine, options, engine_target),
+        }
+        report["speedup"] = report["gpt_seconds"] / report["engine_seconds"]
+        report["bands"] = compare(f"{gpt_target}.dim", f"{engine_target}.dim", tolerance)
+    finally:
+        rmtree(work_dir)
+
+    if tolerance is not None:
+        report["passed"] = all(band.get("within_tolerance", 0) >= options.fraction for band in report["bands"].values())
+    print(json.dumps(report, indent=2))
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if not report.get("passed", True):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = get_argument_parser("Compare multilooking with gpt and with the NumPy engine", "BEAM-DIMAP product of detected bands to multilook.")
+    parser.add_argument("--rangeLooks", type=int, dest="range_looks", default=3, help="The default is %(default)s.")
+    parser.add_argument("--azimuthLooks", type=int, dest="azimuth_looks", default=3, help="The default is %(default)s.")
+    run_comparison(parser.parse_args(), "multilook", run_gpt, run_engine)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# Benchmark of the Lee Sigma speckle filter with gpt against the NumPy engine, on a real BEAM-DIMAP product such
+# as the output of the Calibration step, left behind in the scratch directory by a failed run:
+#
+#     python3 tests/benchmark/speckle_filter.py Calibration.dim --report speckle_filter.json
+#
+# Both use the same window sizes, sigma range and noise variance, but SNAP takes the 98th percentile that marks
+# point targets per tile and the engine over the whole band, so pixels next to bright targets may differ. The
+# check passes when at least --fraction of the pixels where both have data are within a relative --tolerance.
+
+import subprocess
+
+from multilook import engine, get_argument_parser, run_comparison
+
+
+def run_gpt(options, target):
+    subprocess.run(["gpt", "Speckle-Filter", f"-Ssource={options.source}", "-t", target, "-Pfilter=Lee Sigma"], check=True)
+
+
+def run_engine(options, target):
+    engine.run_operator("Speckle-Filter", options.source, target, {"filter": "Lee Sigma"}, options.jobs, options.tile_rows)
+
+
+if __name__ == "__main__":
+    parser = get_argument_parser("Compare the Lee Sigma speckle filter of gpt and of the NumPy engine", "BEAM-DIMAP product of calibrated bands to filter.", tolerance=1e-3, fraction=0.99)
+    run_comparison(parser.parse_args(), "speckle-filter", run_gpt, run_engine)